@@ -1,99 +1,319 @@
-from luma.core.interface.serial import i2c
 from luma.oled.device import ssd1306
 from luma.core.render import canvas
+from PIL import Image, ImageDraw
+from hardware import create_oled
+from supervisor import beat
+import telemetry
 import math
+import os
+import pickle
+import signal
 import time
 
+# Precomputed frames are cached here so startup doesn't have to redraw them
+FRAME_CACHE_DIR = os.path.expanduser("~/.cache/audio-visual-bot")
+FRAME_CACHE_VERSION = 1
+
+# Playback RMS is multiplied by this before drawing, since speech rarely nears full scale
+LEVEL_GAIN = 4.0
+
+# SSD1306 commands for addressing a window of display RAM
+COLUMNADDR = 0x21
+PAGEADDR = 0x22
+
+def render_thinking_frames(width, height):
+    """Frames of dots appearing in sequence for the 'Thinking' state."""
+    dot_positions = [
+        (width // 2 - 20, height // 2),
+        (width // 2, height // 2),
+        (width // 2 + 20, height // 2)
+    ]
+    frames = []
+    for i in range(4):
+        image = Image.new("1", (width, height))
+        draw = ImageDraw.Draw(image)
+        for j in range(i):
+            draw.ellipse(
+                (
+                    dot_positions[j][0] - 2,
+                    dot_positions[j][1] - 2,
+                    dot_positions[j][0] + 2,
+                    dot_positions[j][1] + 2
+                ),
+                fill=255
+            )
+        frames.append(image)
+    return frames
+
+def render_speaking_frames(width, height, intensity=1, step=5):
+    """Frames of a sine waveform scrolling horizontally for the 'Speaking' state."""
+    frames = []
+    for offset in range(0, width, step):
+        image = Image.new("1", (width, height))
+        draw = ImageDraw.Draw(image)
+        for x in range(width):
+            y = int((height // 2) + (math.sin((x + offset) / 10.0) * (10 * intensity)))
+            draw.line((x, height // 2, x, y), fill=255)
+        frames.append(image)
+    return frames
+
+def render_listening_frames(width, height, radius=15):
+    """A single frame with a circle in the center for the 'Listening' state."""
+    image = Image.new("1", (width, height))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse(
+        (
+            width // 2 - radius,
+            height // 2 - radius,
+            width // 2 + radius,
+            height // 2 + radius
+        ),
+        outline=255,
+        fill=0
+    )
+    return [image]
+
+def image_to_pages(image):
+    """
+    Pack a 1-bit image into SSD1306 display RAM layout: one byte per column per 8-row
+    page, least significant bit at the top, pages in order.
+    """
+    width, height = image.size
+    pages = bytearray(width * (height // 8))
+    for idx, pix in enumerate(image.getdata()):
+        if pix > 0:
+            y, x = divmod(idx, width)
+            pages[(y // 8) * width + x] |= 1 << (y % 8)
+    return bytes(pages)
+
+def build_level_columns(height):
+    """
+    Packed display columns for a bar mirrored around the middle row, indexed by the
+    bar's half-height in pixels (0 to height // 2). Each entry has one byte per page.
+    """
+    pages = height // 8
+    middle = height // 2
+    columns = []
+    for half in range(middle + 1):
+        column = [0] * pages
+        for y in range(middle - half, min(height, middle + half + 1)):
+            column[y // 8] |= 1 << (y % 8)
+        columns.append(column)
+    return columns
+
+def render_level_frame(levels, width, height, columns, gain=LEVEL_GAIN):
+    """
+    Pack a scrolling level meter, one column per audio block with the newest on the
+    right: a mirrored bar for the block's RMS, and a pixel pair marking its peak.
+    """
+    middle = height // 2
+    frame = bytearray(width * (height // 8))
+    x = width - len(levels)
+    for rms, peak in levels:
+        half = min(middle, int(rms * gain * middle))
+        for page, byte in enumerate(columns[half]):
+            frame[page * width + x] = byte
+        tick = min(middle - 1, max(half, int(peak * middle)))
+        for y in (middle - tick, middle + tick):
+            frame[(y // 8) * width + x] |= 1 << (y % 8)
+        x += 1
+    return bytes(frame)
+
+def build_frame_atlas(width, height):
+    """Render every animation once and pack the frames into display RAM buffers."""
+    return {
+        "thinking": [image_to_pages(f) for f in render_thinking_frames(width, height)],
+        "speaking": [image_to_pages(f) for f in render_speaking_frames(width, height)],
+        "listening": [image_to_pages(f) for f in render_listening_frames(width, height)],
+    }
+
+def load_frame_atlas(width, height, cache_dir=FRAME_CACHE_DIR):
+    """Load the precomputed frames from disk, building and caching them on first use."""
+    path = os.path.join(cache_dir, f"oled_frames_{width}x{height}.pkl")
+    try:
+        with open(path, "rb") as f:
+            cached = pickle.load(f)
+        if cached.get("version") == FRAME_CACHE_VERSION:
+            return cached["frames"]
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    frames = build_frame_atlas(width, height)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump({"version": FRAME_CACHE_VERSION, "frames": frames}, f)
+    except OSError as e:
+        print(f"Could not cache OLED frames: {e}")
+    return frames
+
+class DiffDisplay:
+    """
+    Pushes packed frames to an SSD1306, sending only the span of columns that changed
+    in each 8-row page since the previous frame.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.width = device.width
+        self.pages = device.height // 8
+        self.previous = None
+        self.bytes_sent = 0
+        self.frames_shown = 0
+
+    def show(self, frame):
+        """Send `frame` (as produced by `image_to_pages`) to the display."""
+        width = self.width
+        bytes_before = self.bytes_sent
+        for page in range(self.pages):
+            start = page * width
+            row = frame[start:start + width]
+
+            if self.previous is None:
+                first, last = 0, width - 1
+            else:
+                old = self.previous[start:start + width]
+                if old == row:
+                    continue
+                first = next(x for x in range(width) if row[x] != old[x])
+                last = next(x for x in range(width - 1, -1, -1) if row[x] != old[x])
+
+            self.device.command(COLUMNADDR, first, last, PAGEADDR, page, page)
+            self.device.data(list(row[first:last + 1]))
+            self.bytes_sent += 6 + (last - first + 1)
+
+        telemetry.inc("oled_frames_total")
+        telemetry.inc("oled_bytes_total", self.bytes_sent - bytes_before)
+        self.previous = frame
+        self.frames_shown += 1
+
 class AnimationHandler:
-    def __init__(self, state):
+    def __init__(self, state, levels=None, device=None, running=None):
         self.state = state
-        self.serial = i2c(port=1, address=0x3C)
-        self.device = ssd1306(self.serial, width=128, height=32)
+        self.levels = levels
+        self.running = running
+        if device is None:
+            device = create_oled(width=128, height=32)
+        self.device = device
+        self.display = DiffDisplay(self.device)
+        self.frames = load_frame_atlas(self.device.width, self.device.height)
+        self.level_columns = build_level_columns(self.device.height)
         print(f"Display size: {self.device.width}x{self.device.height}")
 
+    def active(self):
+        """Whether the robot is still running; always True without a `running` flag."""
+        return self.running is None or self.running.value
+
     def draw_thinking(self):
-        """Draw dots blinking in sequence for 'Thinking' state."""
-        width = self.device.width
-        height = self.device.height
-        dot_positions = [
-            (width // 2 - 20, height // 2),
-            (width // 2, height // 2),
-            (width // 2 + 20, height // 2)
-        ]
+        """Show dots blinking in sequence for 'Thinking' state."""
+        frames = self.frames["thinking"]
         i = 0
-        while self.state.value == "thinking":
-            with canvas(self.device) as draw:
-                for j in range(i % 4):
-                    if j < len(dot_positions):
-                        draw.ellipse(
-                            (
-                                dot_positions[j][0] - 2,
-                                dot_positions[j][1] - 2,
-                                dot_positions[j][0] + 2,
-                                dot_positions[j][1] + 2
-                            ),
-                            fill=255
-                        )
+        while self.active() and self.state.value == "thinking":
+            beat()
+            self.display.show(frames[i % len(frames)])
             i += 1
             time.sleep(0.5)  # Controls the blinking speed
 
-    def draw_speaking(self, intensity=1):
-        """Draw animated waveform for 'Speaking' state."""
+    def draw_speaking(self):
+        """
+        Show a live level meter of the audio being played for 'Speaking' state, or the
+        canned waveform if no playback levels are available.
+        """
         width = self.device.width
         height = self.device.height
-        offset = 0  # This will create the moving effect
-
-        while self.state.value == "speaking":
-            with canvas(self.device) as draw:
-                # Generate the waveform by shifting the sine wave horizontally (using `offset`)
-                for x in range(width):
-                    y = int((height // 2) + (math.sin((x + offset) / 10.0) * (10 * intensity)))
-                    draw.line((x, height // 2, x, y), fill=255)
+        frames = self.frames["speaking"]
+        i = 0
 
-            # Increase the offset to make the waveform "move" over time
-            offset += 5
-            if offset > width:
-                offset = 0
+        while self.active() and self.state.value == "speaking":
+            beat()
+            if self.levels is not None:
+                levels = self.levels.latest(width)
+                self.display.show(render_level_frame(levels, width, height, self.level_columns))
+            else:
+                self.display.show(frames[i % len(frames)])
+                i += 1
 
             # Adjust the delay to control the speed of the animation
             time.sleep(0.05)
 
     def draw_listening(self):
-        """Draw a static circle for 'Listening' state."""
-        width = self.device.width
-        height = self.device.height
-        radius = 15  # Fixed radius
-
-        with canvas(self.device) as draw:
-            # Draw a circle in the center of the screen
-            draw.ellipse(
-                (
-                    width // 2 - radius,
-                    height // 2 - radius,
-                    width // 2 + radius,
-                    height // 2 + radius
-                ),
-                outline=255,
-                fill=0
-            )
+        """Show a static circle for 'Listening' state."""
+        self.display.show(self.frames["listening"][0])
 
     def run(self):
-        """Main loop to handle animations based on the current state."""
-        while True:
-            current_state = self.state.value
-            if current_state == "thinking":
-                self.draw_thinking()
-            elif current_state == "speaking":
-                self.draw_speaking()
-            elif current_state == "listening":
-                self.draw_listening()
-                time.sleep(1)  # Static display, refresh every second
-            else:
-                # idle state
-                print(f"state: {current_state}")
-                time.sleep(1)
+        """Main loop to handle animations based on the current state, until `running` clears."""
+        try:
+            while self.active():
+                beat()
+                current_state = self.state.value
+                if current_state == "thinking":
+                    self.draw_thinking()
+                elif current_state == "speaking":
+                    self.draw_speaking()
+                elif current_state == "listening":
+                    self.draw_listening()
+                    time.sleep(1)  # Static display, refresh every second
+                else:
+                    # idle state
+                    print(f"state: {current_state}")
+                    time.sleep(1)
+        finally:
+            # leave the display blank
+            self.device.clear()
 
-def start_animation_process(state):
+def start_animation_process(state, levels=None, running=None):
     """Function to start the animation handler."""
-    handler = AnimationHandler(state)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor handles Ctrl+C
+    handler = AnimationHandler(state, levels, running=running)
     handler.run()
+
+class CountingSerial:
+    """Serial interface that discards traffic but counts the bytes that would be sent."""
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def cleanup(self):
+        pass
+
+    def command(self, *cmd):
+        self.bytes_sent += len(cmd)
+
+    def data(self, data):
+        self.bytes_sent += len(data)
+
+def benchmark(frames=500, width=128, height=32):
+    """
+    Compare the old per-frame canvas redraw + full-buffer push against the precomputed
+    atlas + diff-only updates, for the speaking animation.
+    """
+    serial = CountingSerial()
+    device = ssd1306(serial, width=width, height=height)
+
+    # Old path: recompute the sine wave and push the whole buffer every frame
+    serial.bytes_sent = 0
+    offset = 0
+    start = time.perf_counter()
+    for _ in range(frames):
+        with canvas(device) as draw:
+            for x in range(width):
+                y = int((height // 2) + (math.sin((x + offset) / 10.0) * 10))
+                draw.line((x, height // 2, x, y), fill=255)
+        offset += 5
+        if offset > width:
+            offset = 0
+    elapsed = time.perf_counter() - start
+    print(f"canvas redraw: {frames / elapsed:8.1f} FPS, {serial.bytes_sent / elapsed:10.0f} bytes/s, "
+          f"{serial.bytes_sent / frames:6.1f} bytes/frame ({20 * serial.bytes_sent / frames:.0f} bytes/s at 20 FPS)")
+
+    # New path: precomputed frames, diff-only updates
+    serial.bytes_sent = 0
+    atlas = build_frame_atlas(width, height)["speaking"]
+    display = DiffDisplay(device)
+    start = time.perf_counter()
+    for i in range(frames):
+        display.show(atlas[i % len(atlas)])
+    elapsed = time.perf_counter() - start
+    print(f"atlas + diff:  {frames / elapsed:8.1f} FPS, {serial.bytes_sent / elapsed:10.0f} bytes/s, "
+          f"{serial.bytes_sent / frames:6.1f} bytes/frame ({20 * serial.bytes_sent / frames:.0f} bytes/s at 20 FPS)")
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,107 @@
+"""
+Attention gating between face tracking and speech recognition.
+
+The vision process records when `ObjectCenter` last saw a face, and the audio player
+records whether the robot is speaking. From those:
+
+- speech recognition only runs at full effort while a face has been seen within the
+  grace period; otherwise the recorder is paused, so background noise doesn't wake Whisper
+- the camera drops to a lower resolution and frame rate when no face has been seen for a
+  while, or while the robot is speaking
+
+The flags are shared memory created at import time, so every forked worker sees the same
+values (like the registry in telemetry.py). Set ROBOT_ATTENTION=0 to always run at full
+effort, e.g. in simulation without a video of a face.
+"""
+import multiprocessing
+import os
+import time
+
+import psutil
+
+import telemetry
+
+GATING = os.getenv("ROBOT_ATTENTION", "1") == "1"
+FACE_GRACE_SECONDS = float(os.getenv("ROBOT_FACE_GRACE", "15"))  # Keep listening this long after the face is lost
+VISION_IDLE_AFTER = float(os.getenv("ROBOT_VISION_IDLE_AFTER", "30"))  # Slow the camera after this long without a face
+
+_last_face = multiprocessing.RawValue('d', 0.0)
+_speaking = multiprocessing.RawValue('b', False)
+
+def saw_face(when=None):
+    """Record a face detection. Only the vision process calls this."""
+    _last_face.value = time.time() if when is None else when
+
+def set_speaking(speaking):
+    """Record whether audio is playing. Only the audio player calls this."""
+    _speaking.value = speaking
+
+def seconds_since_face():
+    return time.time() - _last_face.value
+
+def listening_attentive():
+    """Whether speech recognition should run at full effort."""
+    return not GATING or seconds_since_face() <= FACE_GRACE_SECONDS
+
+def vision_reduced():
+    """Whether the camera should run at its reduced resolution and frame rate."""
+    return GATING and (bool(_speaking.value) or seconds_since_face() > VISION_IDLE_AFTER)
+
+class CpuSavings:
+    """
+    Estimates the CPU-seconds a worker saves while running at reduced effort, from the
+    CPU rate it used the last times it ran at full effort.
+
+    Parameters:
+        metric (str): Telemetry counter the savings are added to.
+        include_children (bool): Count the CPU of child processes too, e.g. a speech
+            recognizer's transcription process.
+        interval (float): Minimum seconds between samples in the same mode.
+        alpha (float): Smoothing of the full-effort CPU rate.
+    """
+    def __init__(self, metric, include_children=False, interval=1.0, alpha=0.2):
+        self.metric = metric
+        self.include_children = include_children
+        self.interval = interval
+        self.alpha = alpha
+        self.process = psutil.Process()
+        self.full_rate = None
+        self.reduced = None
+        self.last_time = time.time()
+        self.last_cpu = self.cpu_seconds()
+
+    def cpu_seconds(self):
+        if not self.include_children:
+            return time.process_time()
+        processes = [self.process] + self.process.children(recursive=True)
+        total = 0.0
+        for process in processes:
+            try:
+                times = process.cpu_times()
+            except psutil.NoSuchProcess:
+                continue
+            total += times.user + times.system
+        return total
+
+    def sample(self, reduced):
+        """
+        Account for the time since the last sample. `reduced` is the current mode: True
+        at reduced effort, False at full effort, or None for time that shouldn't count.
+        """
+        now = time.time()
+        elapsed = now - self.last_time
+        if reduced == self.reduced and elapsed < self.interval:
+            return
+
+        cpu = self.cpu_seconds()
+        # a child process exiting takes its CPU time with it
+        used = max(0.0, cpu - self.last_cpu)
+        if self.reduced is False and elapsed > 0:
+            rate = used / elapsed
+            self.full_rate = rate if self.full_rate is None else self.full_rate + self.alpha * (rate - self.full_rate)
+        elif self.reduced and self.full_rate is not None:
+            telemetry.inc(self.metric, max(0.0, self.full_rate * elapsed - used))
+
+        self.reduced = reduced
+        self.last_time = now
+        self.last_cpu = cpu
@@ -0,0 +1,69 @@
+import multiprocessing
+import numpy as np
+
+class LevelRing:
+    """
+    Ring buffer of per-block (rms, peak) playback levels in shared memory.
+
+    There is a single writer (`audio_player`) and any number of readers (the animation
+    process). No locks are taken: the writer fills a slot and only then advances the
+    counter, so readers never see a slot before it has been written. The buffer is
+    large enough that a reader polling at display rate can't be lapped by the writer.
+    """
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.values = multiprocessing.RawArray('f', capacity * 2)
+        self.count = multiprocessing.RawValue('Q', 0)
+
+    def publish(self, rms, peak):
+        """Append one block's levels (both from 0.0 to 1.0)."""
+        i = (self.count.value % self.capacity) * 2
+        self.values[i] = rms
+        self.values[i + 1] = peak
+        self.count.value += 1
+
+    def latest(self, n):
+        """Return up to `n` of the most recent (rms, peak) pairs, oldest first."""
+        count = self.count.value
+        n = min(n, count, self.capacity)
+        levels = []
+        for k in range(count - n, count):
+            i = (k % self.capacity) * 2
+            levels.append((self.values[i], self.values[i + 1]))
+        return levels
+
+# numpy sample type and full-scale value for each PCM sample width in bytes;
+# 24-bit samples have no numpy type and are unpacked to int32
+SAMPLE_FORMATS = {
+    1: (np.uint8, 128.0),
+    2: (np.int16, 32768.0),
+    3: (None, 8388608.0),
+    4: (np.int32, 2147483648.0),
+}
+
+def unpack_24bit(data):
+    """Unpack little-endian 24-bit PCM to int32 samples."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    raw = raw[:len(raw) - len(raw) % 3].reshape(-1, 3)
+    return raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8) | (raw[:, 2].astype(np.int8).astype(np.int32) << 16)
+
+def block_levels(data, sample_width):
+    """
+    Compute the RMS and peak level of a block of PCM audio, normalized to 0.0-1.0.
+
+    `data` may be bytes or a memoryview; the samples are viewed in place, not copied
+    (except 24-bit samples, which are unpacked). Unknown sample widths read as silence.
+    """
+    if sample_width not in SAMPLE_FORMATS:
+        return 0.0, 0.0
+    dtype, full_scale = SAMPLE_FORMATS[sample_width]
+    samples = unpack_24bit(data) if sample_width == 3 else np.frombuffer(data, dtype=dtype)
+    if len(samples) == 0:
+        return 0.0, 0.0
+    if dtype is np.uint8:
+        # 8-bit PCM is unsigned, centered on 128
+        samples = samples.astype(np.int16) - 128
+
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) / full_scale
+    peak = max(int(samples.max()), -int(samples.min())) / full_scale
+    return min(rms, 1.0), min(peak, 1.0)
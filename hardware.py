@@ -0,0 +1,217 @@
+"""
+Hardware backends for the robot, with file, synthetic and null stand-ins so the whole
+multiprocess stack can run on a plain Linux box.
+
+Set ROBOT_SIMULATION=1 to use the stand-ins. Optional inputs:
+    ROBOT_SIM_VIDEO  - video or still image to serve as camera frames. A still image is
+                       panned side to side so the face tracker has something to follow.
+                       Without it, frames are synthetic noise.
+    ROBOT_SIM_AUDIO  - 16-bit PCM WAV file fed to the speech recognizer in a loop in place
+                       of the microphone. Any sample rate and channel count works; it's
+                       downmixed to mono and resampled to 16 kHz. Without it, the
+                       recognizer hears silence.
+"""
+import math
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+
+SIMULATION = os.getenv("ROBOT_SIMULATION", "0") == "1"
+SIM_VIDEO = os.getenv("ROBOT_SIM_VIDEO")
+SIM_AUDIO = os.getenv("ROBOT_SIM_AUDIO")
+
+# Whether there is a screen to show the camera preview on
+HAS_DISPLAY = not SIMULATION or bool(os.getenv("DISPLAY"))
+
+class FakeServo:
+    def __init__(self):
+        self.angle = None
+
+class FakeServoKit:
+    """Stand-in for adafruit_servokit.ServoKit that just remembers the angles."""
+    def __init__(self, channels=16):
+        self.servo = [FakeServo() for _ in range(channels)]
+
+class FakeCamera:
+    """
+    Stand-in for Picamera2 that serves XRGB8888-shaped frames from a file, or synthetic
+    frames, at the camera's frame rate.
+    """
+    def __init__(self, source=SIM_VIDEO, fps=30):
+        self.source = source
+        self.fps = fps
+        self.size = (640, 480)
+        self.video = None
+        self.image = None
+        self.next_frame_time = 0
+
+    def create_preview_configuration(self, main):
+        return {"main": main}
+
+    def configure(self, config):
+        self.size = config["main"]["size"]
+
+    def start(self):
+        import cv2
+        if self.source is None:
+            return
+        self.image = cv2.imread(self.source)
+        if self.image is None:
+            self.video = cv2.VideoCapture(self.source)
+        else:
+            self.image = cv2.resize(self.image, self.size)
+
+    def stop(self):
+        if self.video is not None:
+            self.video.release()
+
+    def capture_array(self):
+        import cv2
+
+        # pace frames like a real camera
+        now = time.time()
+        if now < self.next_frame_time:
+            time.sleep(self.next_frame_time - now)
+        self.next_frame_time = max(now, self.next_frame_time) + 1.0 / self.fps
+
+        (width, height) = self.size
+        if self.video is not None:
+            ok, frame = self.video.read()
+            if not ok:
+                # loop the video
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ok, frame = self.video.read()
+            frame = cv2.resize(frame, self.size)
+        elif self.image is not None:
+            # sway the still image side to side so the face moves across the frame
+            shift = int(width * 0.15 * math.sin(time.time() * 0.8))
+            frame = np.roll(self.image, shift, axis=1)
+        else:
+            frame = np.random.randint(0, 255, (height, width, 3), dtype=np.uint8)
+
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+
+class FakePWMChannel:
+    def __init__(self):
+        self.duty_cycle = 0
+
+class FakePCA9685:
+    """Stand-in for adafruit_pca9685.PCA9685 that discards PWM writes."""
+    def __init__(self):
+        self.frequency = 0
+        self.channels = [FakePWMChannel() for _ in range(16)]
+
+    def deinit(self):
+        pass
+
+class NullStream:
+    """PyAudio output stream that discards audio, blocking for as long as playback would take."""
+    def __init__(self, format, channels, rate, **kwargs):
+        self.frame_width = format * channels
+        self.rate = rate
+
+    def write(self, data):
+        time.sleep(len(data) / (self.frame_width * self.rate))
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+class NullPyAudio:
+    """Stand-in for pyaudio.PyAudio with no sound card behind it."""
+    def get_format_from_width(self, width):
+        # the null stream only needs the sample width to pace playback
+        return width
+
+    def open(self, **kwargs):
+        return NullStream(**kwargs)
+
+    def terminate(self):
+        pass
+
+def check_sim_audio(path):
+    """Make sure a WAV file can be fed to the recognizer, which needs 16-bit samples."""
+    with wave.open(path, 'rb') as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"{path}: ROBOT_SIM_AUDIO must be 16-bit PCM, not {8 * wf.getsampwidth()}-bit")
+
+def feed_recorder(recorder, path, chunk_frames=1024, gap_seconds=3.0):
+    """Feed a WAV file (or silence) to a recorder in real time, in place of the microphone."""
+    silence = np.zeros(chunk_frames, dtype=np.int16).tobytes()
+    while True:
+        if path is None:
+            recorder.feed_audio(silence, original_sample_rate=16000)
+            time.sleep(chunk_frames / 16000)
+            continue
+
+        with wave.open(path, 'rb') as wf:
+            rate = wf.getframerate()
+            channels = wf.getnchannels()
+            data = wf.readframes(chunk_frames)
+            while data:
+                # the recorder takes raw bytes as 16 kHz mono, so hand it a mono array it
+                # can resample instead
+                samples = np.frombuffer(data, dtype=np.int16).reshape(-1, channels).mean(axis=1)
+                recorder.feed_audio(samples, original_sample_rate=rate)
+                time.sleep(len(samples) / rate)
+                data = wf.readframes(chunk_frames)
+
+        # pause between repeats, like someone waiting for a reply
+        for _ in range(int(gap_seconds * 16000 / chunk_frames)):
+            recorder.feed_audio(silence, original_sample_rate=16000)
+            time.sleep(chunk_frames / 16000)
+
+def create_servo_kit():
+    if SIMULATION:
+        return FakeServoKit(channels=16)
+    from adafruit_servokit import ServoKit
+    return ServoKit(channels=16)
+
+def create_camera():
+    if SIMULATION:
+        return FakeCamera()
+    from picamera2 import Picamera2
+    return Picamera2()
+
+def create_pca9685():
+    if SIMULATION:
+        return FakePCA9685()
+    import board
+    import busio
+    from adafruit_pca9685 import PCA9685
+
+    # Initialize I2C bus.
+    i2c = busio.I2C(board.SCL, board.SDA)
+
+    # Initialize PCA9685 using the I2C bus
+    return PCA9685(i2c)
+
+def create_oled(width=128, height=32):
+    if SIMULATION:
+        from luma.core.device import dummy
+        return dummy(width=width, height=height, mode="1")
+    from luma.core.interface.serial import i2c
+    from luma.oled.device import ssd1306
+    return ssd1306(i2c(port=1, address=0x3C), width=width, height=height)
+
+def create_pyaudio():
+    if SIMULATION:
+        return NullPyAudio()
+    import pyaudio
+    return pyaudio.PyAudio()
+
+def create_recorder(**kwargs):
+    from RealtimeSTT import AudioToTextRecorder
+    if not SIMULATION:
+        return AudioToTextRecorder(**kwargs)
+
+    if SIM_AUDIO is not None:
+        check_sim_audio(SIM_AUDIO)
+    recorder = AudioToTextRecorder(use_microphone=False, **kwargs)
+    threading.Thread(target=feed_recorder, args=(recorder, SIM_AUDIO), daemon=True).start()
+    return recorder
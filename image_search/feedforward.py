@@ -0,0 +1,82 @@
+import time
+
+class AxisCalibration:
+    """
+    Maps a pixel offset along one camera axis to a servo command offset, using the
+    camera's field of view.
+
+    Parameters:
+        frame_size (int): Pixels along this axis.
+        fov (float): Camera field of view along this axis, degrees.
+        degrees_per_unit (float): Degrees the camera actually turns per unit of servo
+            command. Cheap servos often turn less (or more) than the angle they're given.
+    """
+    def __init__(self, frame_size, fov, degrees_per_unit=1.0):
+        self.frame_size = frame_size
+        self.fov = fov
+        self.degrees_per_unit = degrees_per_unit
+
+    def degrees(self, pixels):
+        """Angle of a pixel offset from the frame center, degrees."""
+        return pixels * self.fov / self.frame_size
+
+    def servo_offset(self, pixels):
+        """Servo command change that brings a pixel offset to the frame center."""
+        return self.degrees(pixels) / self.degrees_per_unit
+
+def measure_degrees_per_unit(pixel_shift, units_moved, frame_size, fov):
+    """
+    Calibrate `degrees_per_unit` from a measurement: point the camera at a still target,
+    move the servo by `units_moved`, and note how many pixels the target shifted.
+    """
+    return abs(pixel_shift) * fov / frame_size / abs(units_moved)
+
+class FeedForwardPID:
+    """
+    Combined controller for one axis: when the face is far off-center, jump straight to
+    its computed angle, then leave fine tracking to the PID.
+
+    Frames captured before a jump has landed still show the old error, so they're
+    ignored until the servo has had time to get there.
+
+    Parameters:
+        pid (PID): Controller for small errors.
+        calibration (AxisCalibration): Camera and servo geometry for this axis.
+        jump_threshold (float): Errors larger than this many degrees trigger a jump.
+        servo_speed (float): Degrees per second the servo slews.
+        settle_margin (float): Extra seconds to wait after a jump lands.
+    """
+    def __init__(self, pid, calibration, jump_threshold=5.0, servo_speed=400.0, settle_margin=0.05):
+        self.pid = pid
+        self.calibration = calibration
+        self.jump_threshold = jump_threshold
+        self.servo_speed = servo_speed
+        self.settle_margin = settle_margin
+        self.jumps = 0
+
+    def initialize(self, now=None):
+        self.pid.initialize(now)
+        self.blind_until = 0.0
+
+    def update(self, error, now=None, captured_at=None):
+        """
+        Return the servo command change for a pixel error. `captured_at` is when the
+        detected frame was captured (defaults to `now`).
+        """
+        now = time.time() if now is None else now
+        captured_at = now if captured_at is None else captured_at
+
+        # this frame was captured before the last jump landed
+        if captured_at < self.blind_until:
+            return 0.0
+
+        if abs(self.calibration.degrees(error)) > self.jump_threshold:
+            offset = self.calibration.servo_offset(error)
+            self.jumps += 1
+            self.blind_until = now + abs(offset) / self.servo_speed + self.settle_margin
+
+            # start fine tracking fresh from the new position
+            self.pid.initialize(now)
+            return offset
+
+        return self.pid.update(error, now)
@@ -1,17 +1,28 @@
+import time
+
 import imutils
 import cv2
 
 class ObjectCenter:
-    def __init__(self, haar_path):
+    def __init__(self, haar_path, min_size=30, full_width=640):
         # load OpenCV's Haar cascade face detector
         self.detector = cv2.CascadeClassifier(haar_path)
 
+        # smallest face to detect, in pixels of a `full_width` frame; scaled down for
+        # smaller frames (the cascade's own 24 px window is the floor)
+        self.min_size = min_size
+        self.full_width = full_width
+
+        # time.time() of the latest detection
+        self.last_seen = 0.0
+
     def update(self, frame, frame_center):
         # convert the frame to grayscale
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
         # detect all faces in the input frame
-        rects = self.detector.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=9, minSize=(30, 30), flags=cv2.CASCADE_SCALE_IMAGE)
+        min_size = max(1, round(self.min_size * frame.shape[1] / self.full_width))
+        rects = self.detector.detectMultiScale(gray, scaleFactor=1.05, minNeighbors=9, minSize=(min_size, min_size), flags=cv2.CASCADE_SCALE_IMAGE)
 
         # check to see if a face was found
         if len(rects) > 0:
@@ -20,6 +31,7 @@ class ObjectCenter:
             (x, y, w, h) = rects[0]
             faceX = int(x + (w / 2.0))
             faceY = int(y + (h / 2.0))
+            self.last_seen = time.time()
 
             # return the center (x, y)-coordinates of the face
             return ((faceX, faceY), rects[0])
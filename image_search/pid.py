@@ -1,17 +1,29 @@
 import time
 
+# Gains (kP, kI, kD) and starting servo angles used by object_tracking.control_loop.
+# image_search.simulator reads these too, so tuning always runs against the robot's setup.
+PAN_GAINS = (0.0125, 0.0005, 0.001)
+TILT_GAINS = (0.005, 0.001, 0.001)
+START_ANGLES = (90, 180)  # (pan, tilt); tilt starts at the top of the servo's range
+
 # thanks to Adrian Rosebrock whose code this was based on:
 # https://pyimagesearch.com/2019/04/01/pan-tilt-face-tracking-with-a-raspberry-pi-and-opencv/
 class PID:
-    def __init__(self, kP=1, kI=0, kD=0):
+    def __init__(self, kP=1, kI=0, kD=0, integral_limit=None, derivative_alpha=1.0):
         # initialize gains
         self.kP = kP
         self.kI = kI
         self.kD = kD
 
-    def initialize(self):
+        # anti-windup: clamp the integral term to +/- integral_limit (None disables)
+        self.integral_limit = integral_limit
+
+        # derivative low-pass filter coefficient in (0, 1]; 1.0 means no filtering
+        self.derivative_alpha = derivative_alpha
+
+    def initialize(self, now=None):
         # initialize the current and previous time
-        self.currTime = time.time()
+        self.currTime = time.time() if now is None else now
         self.prevTime = self.currTime
 
         # initialize the previous error
@@ -22,9 +34,9 @@ class PID:
         self.cI = 0
         self.cD = 0
 
-    def update(self, error):
+    def update(self, error, now=None):
         # grab the current time and calculate delta time
-        self.currTime = time.time()
+        self.currTime = time.time() if now is None else now
         deltaTime = self.currTime - self.prevTime
 
         # delta error
@@ -33,11 +45,14 @@ class PID:
         # proportional term
         self.cP = error
 
-        # integral term
+        # integral term, clamped so it can't wind up while the servos are saturated
         self.cI += error * deltaTime
+        if self.integral_limit is not None:
+            self.cI = max(-self.integral_limit, min(self.integral_limit, self.cI))
 
-        # derivative term and prevent divide by zero
-        self.cD = (deltaError / deltaTime) if deltaTime > 0 else 0
+        # derivative term and prevent divide by zero, smoothed by an exponential filter
+        rawD = (deltaError / deltaTime) if deltaTime > 0 else 0
+        self.cD = self.derivative_alpha * rawD + (1 - self.derivative_alpha) * self.cD
 
         # save previous time and error for the next update
         self.prevTime = self.currTime
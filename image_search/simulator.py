@@ -0,0 +1,379 @@
+"""
+Offline closed-loop simulator for the pan/tilt face tracker.
+
+Models one servo axis looking at a face through the camera: the face moves along a
+scripted trajectory, the camera produces a (late, noisy, quantized) pixel error at the
+camera frame rate, the PID turns that into a new servo command, and the servo slews
+toward the command at a limited speed. Thousands of gain sets are run side by side with
+numpy, and an auto-tuning mode searches for gains with the best settle time, overshoot
+and steady-state error. `--feedforward` compares settle times of pure PID against the
+combined feed-forward + PID controller used by the control loop.
+
+Usage:
+    python -m image_search.simulator --axis pan --evaluate 0.0125 0.0005 0.001
+    python -m image_search.simulator --axis tilt --tune --samples 4000
+    python -m image_search.simulator --axis pan --feedforward --jump-threshold 5
+"""
+from collections import deque
+import argparse
+import math
+
+import numpy as np
+
+from image_search.feedforward import AxisCalibration, FeedForwardPID
+from image_search.pid import PAN_GAINS, PID, START_ANGLES, TILT_GAINS
+
+
+class Plant:
+    """Servo + camera model for a single axis."""
+
+    def __init__(self, frame_size=640, fov=62.2, fps=15.0, latency=0.08, servo_speed=400.0,
+                 servo_range=(0, 180), start_angle=90.0, noise_px=2.0):
+        self.frame_size = frame_size    # pixels along this axis
+        self.fov = fov                  # camera field of view along this axis, degrees
+        self.fps = fps                  # detections per second
+        self.latency = latency          # capture -> servo command, seconds
+        self.servo_speed = servo_speed  # degrees per second
+        self.servo_range = servo_range
+        self.start_angle = start_angle
+        self.noise_px = noise_px        # std dev of detection jitter, pixels
+
+    def pixels_per_degree(self):
+        return self.frame_size / self.fov
+
+    def direction(self):
+        """Trajectories head toward the middle of the servo range, so a start at a limit stays reachable."""
+        return 1.0 if self.start_angle <= sum(self.servo_range) / 2 else -1.0
+
+    def face_angles(self, trajectory, t):
+        """
+        Face angle over time for a trajectory, headed toward `direction()`. Trajectories
+        that swing both ways (or drift) are shifted toward the middle of the servo range
+        just enough to stay reachable, so a start at a limit measures tracking rather
+        than saturation.
+        """
+        face = self.start_angle + self.direction() * trajectory(t)
+        low, high = self.servo_range
+        if face.min() < low:
+            face = face + (low - face.min())
+        if face.max() > high:
+            face = face - (face.max() - high)
+        return face
+
+
+# the Pi camera v2 is 62.2 x 48.8 degrees; frames are 640x480 in find_object_center.
+# The servos start where the control loop starts them, so tilt begins saturated at 180.
+AXES = {
+    "pan": dict(frame_size=640, fov=62.2, start_angle=float(START_ANGLES[0])),
+    "tilt": dict(frame_size=480, fov=48.8, start_angle=float(START_ANGLES[1])),
+}
+
+# gains currently used by the control loop
+CURRENT_GAINS = {
+    "pan": PAN_GAINS,
+    "tilt": TILT_GAINS,
+}
+
+
+# --- scripted face trajectories (face angle relative to the servo's start angle, degrees,
+#     in the direction of Plant.direction and kept in range by Plant.face_angles)
+
+def step_trajectory(t, size=15.0):
+    """Face appears `size` degrees off-center at t=0 and stays put."""
+    return np.full_like(t, size)
+
+def ramp_trajectory(t, speed=20.0, duration=1.0):
+    """Face walks across the frame at `speed` deg/s, then stops."""
+    return speed * np.minimum(t, duration)
+
+def sine_trajectory(t, amplitude=10.0, frequency=0.5):
+    """Face sways side to side."""
+    return amplitude * np.sin(2 * math.pi * frequency * t)
+
+def walk_trajectory(t, step_std=0.4, seed=1):
+    """Smoothed random walk, like someone shifting around in a chair."""
+    rng = np.random.default_rng(seed)
+    walk = np.cumsum(rng.normal(0, step_std, size=len(t)))
+    kernel = np.ones(25) / 25
+    return np.convolve(walk, kernel, mode="same")
+
+TRAJECTORIES = {
+    "step": step_trajectory,
+    "ramp": ramp_trajectory,
+    "sine": sine_trajectory,
+    "walk": walk_trajectory,
+}
+
+
+def run_batch(gains, trajectory, plant, duration=4.0, dt=0.005, integral_limit=None, derivative_alpha=1.0, seed=0):
+    """
+    Simulate every gain set in `gains` (shape (B, 3): kP, kI, kD) against the same face
+    trajectory. `integral_limit` and `derivative_alpha` mirror the PID class options and
+    may be scalars or arrays of shape (B,).
+
+    Returns the tracking error in degrees (face angle minus servo angle), shape (steps, B).
+    """
+    gains = np.atleast_2d(np.asarray(gains, dtype=float))
+    kP, kI, kD = gains[:, 0], gains[:, 1], gains[:, 2]
+    batch = len(gains)
+    rng = np.random.default_rng(seed)
+
+    t = np.arange(0, duration, dt)
+    face = plant.face_angles(trajectory, t)
+
+    alpha = np.broadcast_to(np.asarray(derivative_alpha, dtype=float), (batch,))
+    limit = None if integral_limit is None else np.broadcast_to(np.asarray(integral_limit, dtype=float), (batch,))
+
+    angle = np.full(batch, plant.start_angle)    # where the servo actually is
+    command = np.full(batch, plant.start_angle)  # where the control loop told it to go
+    cI = np.zeros(batch)
+    cD = np.zeros(batch)
+    prev_error = np.zeros(batch)
+    prev_time = np.zeros(batch)
+
+    frame_every = max(1, int(round(1.0 / (plant.fps * dt))))
+    delay_steps = int(round(plant.latency / dt))
+    max_move = plant.servo_speed * dt
+    ppd = plant.pixels_per_degree()
+
+    pending = deque()
+    errors = np.empty((len(t), batch))
+
+    for k in range(len(t)):
+        now = t[k]
+
+        # camera captures a frame; the detection reaches the control loop `latency` later
+        if k % frame_every == 0:
+            offset = face[k] - angle
+            visible = np.abs(offset) <= plant.fov / 2
+            pixels = np.round(offset * ppd + rng.normal(0, plant.noise_px, size=batch))
+            pending.append((k + delay_steps, pixels, visible))
+
+        while pending and pending[0][0] <= k:
+            _, error, visible = pending.popleft()
+
+            # same arithmetic as PID.update, applied only where a face was detected
+            delta_time = now - prev_time
+            new_cI = cI + error * delta_time
+            if limit is not None:
+                new_cI = np.clip(new_cI, -limit, limit)
+            raw_d = np.where(delta_time > 0, (error - prev_error) / np.where(delta_time > 0, delta_time, 1), 0)
+            new_cD = alpha * raw_d + (1 - alpha) * cD
+            adjustment = kP * error + kI * new_cI + kD * new_cD
+
+            cI = np.where(visible, new_cI, cI)
+            cD = np.where(visible, new_cD, cD)
+            prev_error = np.where(visible, error, prev_error)
+            prev_time = np.where(visible, now, prev_time)
+            command = np.where(visible, np.clip(command + adjustment, *plant.servo_range), command)
+
+        # servo slews toward the command at its maximum speed
+        angle = angle + np.clip(command - angle, -max_move, max_move)
+        errors[k] = face[k] - angle
+
+    return errors
+
+
+def simulate_pid(pid, trajectory, plant, duration=4.0, dt=0.005, seed=0):
+    """
+    Run a single `PID` (or `FeedForwardPID`) instance through the same plant model as
+    `run_batch`, one step at a time. Useful for checking the vectorised runner against the
+    real class.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(0, duration, dt)
+    face = plant.face_angles(trajectory, t)
+
+    pid.initialize(now=0.0)
+    angle = command = plant.start_angle
+    frame_every = max(1, int(round(1.0 / (plant.fps * dt))))
+    delay_steps = int(round(plant.latency / dt))
+    max_move = plant.servo_speed * dt
+    ppd = plant.pixels_per_degree()
+
+    pending = deque()
+    errors = np.empty(len(t))
+
+    for k in range(len(t)):
+        if k % frame_every == 0:
+            offset = face[k] - angle
+            pixels = round(offset * ppd + rng.normal(0, plant.noise_px))
+            pending.append((k + delay_steps, pixels, abs(offset) <= plant.fov / 2, t[k]))
+
+        while pending and pending[0][0] <= k:
+            _, error, visible, captured_at = pending.popleft()
+            if visible:
+                if isinstance(pid, FeedForwardPID):
+                    adjustment = pid.update(error, now=t[k], captured_at=captured_at)
+                else:
+                    adjustment = pid.update(error, now=t[k])
+                command = max(plant.servo_range[0], min(plant.servo_range[1], command + adjustment))
+
+        angle += max(-max_move, min(max_move, command - angle))
+        errors[k] = face[k] - angle
+
+    return errors
+
+
+def tracking_metrics(errors, dt=0.005, settle_band=2.0, tail=0.2):
+    """
+    Summarize tracking errors (shape (steps, B), degrees) per gain set:
+        settle_time  - seconds until the error stays within +/- settle_band (inf if never)
+        overshoot    - degrees the servo swings past the face, opposite the initial error
+        steady_state - mean absolute error over the last `tail` fraction of the run
+    """
+    errors = np.atleast_2d(errors.T).T
+    steps = errors.shape[0]
+
+    outside = np.abs(errors) > settle_band
+    # index of the last sample that was outside the band, per column
+    last_outside = steps - 1 - np.argmax(outside[::-1], axis=0)
+    settle_time = np.where(outside.any(axis=0), (last_outside + 1) * dt, 0.0)
+    settle_time = np.where(outside[-1], np.inf, settle_time)
+
+    peak = errors[np.argmax(np.abs(errors), axis=0), np.arange(errors.shape[1])]
+    overshoot = np.maximum(0.0, np.max(-np.sign(peak) * errors, axis=0))
+
+    steady_state = np.mean(np.abs(errors[int(steps * (1 - tail)):]), axis=0)
+
+    return {"settle_time": settle_time, "overshoot": overshoot, "steady_state": steady_state}
+
+
+def evaluate(gains, plant, trajectories=TRAJECTORIES, duration=4.0, dt=0.005, **pid_options):
+    """Run every trajectory for a batch of gains and return {trajectory name: metrics}."""
+    return {
+        name: tracking_metrics(run_batch(gains, trajectory, plant, duration, dt, **pid_options), dt)
+        for name, trajectory in trajectories.items()
+    }
+
+
+def tuning_cost(results, duration=4.0, overshoot_weight=0.1, steady_state_weight=1.0):
+    """Combine per-trajectory metrics into one cost per gain set (lower is better)."""
+    cost = 0
+    for metrics in results.values():
+        cost = cost + np.minimum(metrics["settle_time"], duration)
+        cost = cost + overshoot_weight * metrics["overshoot"]
+        cost = cost + steady_state_weight * metrics["steady_state"]
+    return cost
+
+
+def sample_gains(rng, samples, low, high):
+    """Draw log-uniform (kP, kI, kD) gain sets between the `low` and `high` corners."""
+    low, high = np.log(low), np.log(high)
+    return np.exp(rng.uniform(low, high, size=(samples, 3)))
+
+
+def auto_tune(plant, samples=2000, rounds=3, duration=4.0, seed=0, **pid_options):
+    """
+    Random search over gains, zooming in around the best set each round.
+
+    Returns (best gains, best cost).
+    """
+    rng = np.random.default_rng(seed)
+    low = np.array([1e-3, 1e-5, 1e-5])
+    high = np.array([1e-1, 1e-2, 1e-2])
+    best_gains, best_cost = None, np.inf
+
+    for round_number in range(rounds):
+        gains = sample_gains(rng, samples, low, high)
+        if best_gains is not None:
+            gains[0] = best_gains
+        cost = tuning_cost(evaluate(gains, plant, duration=duration, **pid_options), duration)
+
+        i = int(np.argmin(cost))
+        if cost[i] < best_cost:
+            best_gains, best_cost = gains[i], cost[i]
+        print(f"[INFO] Round {round_number + 1}: best cost {best_cost:.3f} with gains {tuple(round(float(g), 6) for g in best_gains)}")
+
+        # narrow the search to a factor of 3 around the current best
+        low, high = best_gains / 3, best_gains * 3
+
+    return tuple(float(g) for g in best_gains), float(best_cost)
+
+
+def compare_feedforward(gains, plant, calibration, jump_threshold=5.0, duration=4.0, seeds=5,
+                        trajectories=TRAJECTORIES, **pid_options):
+    """
+    Settle time and mean absolute error of pure PID against feed-forward + PID with the
+    same gains, averaged over detection-noise seeds.
+
+    Returns {trajectory name: {"pid" or "combined": (settle time, mean abs error)}}.
+    """
+    results = {}
+    for name, trajectory in trajectories.items():
+        runs = {"pid": [], "combined": []}
+        for seed in range(seeds):
+            controllers = {
+                "pid": PID(*gains, **pid_options),
+                "combined": FeedForwardPID(PID(*gains, **pid_options), calibration, jump_threshold, plant.servo_speed),
+            }
+            for mode, controller in controllers.items():
+                errors = simulate_pid(controller, trajectory, plant, duration, seed=seed)
+                runs[mode].append((tracking_metrics(errors)["settle_time"][0], np.mean(np.abs(errors))))
+        results[name] = {mode: tuple(float(v) for v in np.mean(values, axis=0)) for mode, values in runs.items()}
+    return results
+
+
+def print_report(gains, plant, duration=4.0, **pid_options):
+    results = evaluate([gains], plant, duration=duration, **pid_options)
+    print(f"Gains (kP, kI, kD) = {tuple(round(float(g), 6) for g in gains)}")
+    for name, metrics in results.items():
+        print(f"  {name:5s} settle {metrics['settle_time'][0]:6.2f} s  "
+              f"overshoot {metrics['overshoot'][0]:6.2f} deg  "
+              f"steady-state {metrics['steady_state'][0]:6.2f} deg")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate and tune the pan/tilt PID")
+    parser.add_argument("--axis", choices=AXES.keys(), default="pan")
+    parser.add_argument("--evaluate", nargs=3, type=float, metavar=("KP", "KI", "KD"),
+                        help="report metrics for one gain set (defaults to the current gains)")
+    parser.add_argument("--tune", action="store_true", help="search for recommended gains")
+    parser.add_argument("--samples", type=int, default=2000, help="gain sets per tuning round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=4.0)
+    parser.add_argument("--fps", type=float, default=15.0)
+    parser.add_argument("--latency", type=float, default=0.08)
+    parser.add_argument("--servo-speed", type=float, default=400.0)
+    parser.add_argument("--integral-limit", type=float, default=None)
+    parser.add_argument("--derivative-alpha", type=float, default=1.0)
+    parser.add_argument("--feedforward", action="store_true",
+                        help="compare settle times of pure PID and feed-forward + PID")
+    parser.add_argument("--jump-threshold", type=float, default=5.0,
+                        help="errors above this many degrees trigger a feed-forward jump")
+    parser.add_argument("--ff-fov", type=float, default=None,
+                        help="field of view the controller assumes, to test miscalibration")
+    parser.add_argument("--ff-degrees-per-unit", type=float, default=1.0,
+                        help="servo degrees per unit the controller assumes")
+    args = parser.parse_args()
+
+    plant = Plant(fps=args.fps, latency=args.latency, servo_speed=args.servo_speed, **AXES[args.axis])
+    pid_options = dict(integral_limit=args.integral_limit, derivative_alpha=args.derivative_alpha)
+
+    print("Current gains:")
+    print_report(CURRENT_GAINS[args.axis], plant, args.duration, **pid_options)
+
+    if args.evaluate:
+        print_report(tuple(args.evaluate), plant, args.duration, **pid_options)
+
+    if args.feedforward:
+        gains = tuple(args.evaluate) if args.evaluate else CURRENT_GAINS[args.axis]
+        calibration = AxisCalibration(plant.frame_size, args.ff_fov or plant.fov, args.ff_degrees_per_unit)
+        results = compare_feedforward(gains, plant, calibration, args.jump_threshold, args.duration, **pid_options)
+        print(f"\nSettle time, pure PID vs feed-forward + PID (jump above {args.jump_threshold} deg):")
+        for name, modes in results.items():
+            (pid_settle, pid_error), (combined_settle, combined_error) = modes["pid"], modes["combined"]
+            print(f"  {name:5s} settle {pid_settle:6.2f} s -> {combined_settle:6.2f} s  "
+                  f"mean error {pid_error:6.2f} deg -> {combined_error:6.2f} deg")
+
+    if args.tune:
+        gains, cost = auto_tune(plant, args.samples, args.rounds, args.duration, **pid_options)
+        print(f"\nRecommended {args.axis} gains:")
+        print_report(gains, plant, args.duration, **pid_options)
+
+        # double-check the recommendation with the real PID class
+        pid = PID(*gains, integral_limit=args.integral_limit, derivative_alpha=args.derivative_alpha)
+        metrics = tracking_metrics(simulate_pid(pid, step_trajectory, plant, args.duration))
+        print(f"  PID class step check: settle {metrics['settle_time'][0]:.2f} s, "
+              f"overshoot {metrics['overshoot'][0]:.2f} deg")
+        print(f"\nIn image_search/pid.py: {args.axis.upper()}_GAINS = {tuple(round(g, 6) for g in gains)}")
@@ -0,0 +1,371 @@
+"""
+Shared LAN inference server for speech recognition, sentiment and local TTS, so a fleet
+of robots can offload their models to one machine.
+
+Requests from all connected robots are queued per model and run in dynamic batches: a
+batch closes when it reaches `max_batch` requests or `max_wait` seconds after its first
+request. Sentiment requests are scored in a single forward pass per batch; Whisper and
+Piper run the batch's requests back to back on one thread each.
+
+Protocol (TCP): each message is one JSON line, followed by `length` bytes of payload.
+    {"op": "sentiment", "texts": [...]}                      -> {"labels": [...]}
+    {"op": "stt", "length": n}  + float32 16 kHz mono PCM    -> {"text": "..."}
+    {"op": "tts", "text": "..."}                             -> {"length": n} + WAV bytes
+    {"op": "stats"}                                          -> per-model batch counters
+
+Robots use the server when ROBOT_INFERENCE_SERVER=host:port is set, and fall back to
+their own models whenever it can't be reached.
+
+Usage:
+    python inference_server.py --models stt sentiment tts
+    python inference_server.py --benchmark --clients 8 --models sentiment
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import threading
+import time
+import wave
+
+import numpy as np
+
+INFERENCE_SERVER = os.getenv("ROBOT_INFERENCE_SERVER")  # "host:port", or None to run everything locally
+DEFAULT_PORT = 9300
+
+class InferenceUnavailable(Exception):
+    """The inference server couldn't be reached or failed the request."""
+
+class InferenceClient:
+    """
+    Blocking client for the inference server. Connects lazily, so it can be created
+    before worker processes fork. After a failure the server isn't tried again for
+    `retry_after` seconds, so callers fall straight back to local inference.
+
+    Requests share one connection and are serialized with a lock, so the client can be
+    used from several threads.
+
+    Parameters:
+        address (str): "host:port" of the server.
+        connect_timeout (float): Seconds to wait for a connection, kept short so an
+            unreachable server fails fast.
+        timeout (float): Seconds to wait for each response.
+        retry_after (float): Seconds to skip the server after a failure.
+    """
+    def __init__(self, address=INFERENCE_SERVER, connect_timeout=1.0, timeout=10.0, retry_after=30.0):
+        host, _, port = address.rpartition(":")
+        self.address = (host or address, int(port) if host else DEFAULT_PORT)
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.sock = None
+        self.reader = None
+        self.down_until = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+    def request(self, request, payload=b""):
+        # one request at a time on the shared connection
+        with self.lock:
+            return self.locked_request(request, payload)
+
+    def locked_request(self, request, payload):
+        if time.time() < self.down_until:
+            raise InferenceUnavailable("server marked down")
+
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+                self.sock.settimeout(self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.reader = self.sock.makefile("rb")
+
+            request = dict(request, length=len(payload))
+            self.sock.sendall(json.dumps(request).encode() + b"\n" + payload)
+
+            line = self.reader.readline()
+            if not line:
+                raise ConnectionError("server closed the connection")
+            response = json.loads(line)
+            data = self.reader.read(response.get("length", 0))
+        except (OSError, ValueError) as e:
+            self.close()
+            self.down_until = time.time() + self.retry_after
+            print(f"Inference server {self.address[0]}:{self.address[1]} unavailable: {e}")
+            raise InferenceUnavailable(str(e))
+
+        if "error" in response:
+            raise InferenceUnavailable(response["error"])
+        return response, data
+
+    def sentiment(self, texts):
+        """Return a sentiment label for each text."""
+        response, _ = self.request({"op": "sentiment", "texts": list(texts)})
+        return response["labels"]
+
+    def transcribe(self, audio):
+        """Transcribe float32 16 kHz mono audio."""
+        response, _ = self.request({"op": "stt"}, np.asarray(audio, dtype=np.float32).tobytes())
+        return response["text"]
+
+    def synthesize(self, text):
+        """Return WAV file bytes for `text`."""
+        _, data = self.request({"op": "tts", "text": text})
+        return data
+
+    def stats(self):
+        response, _ = self.request({"op": "stats"})
+        return response["stats"]
+
+class Batcher:
+    """Queue for one model that runs requests in dynamic batches on its own thread."""
+    def __init__(self, name, run_batch, max_batch, max_wait):
+        self.name = name
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.batches = 0
+        self.requests = 0
+        self.busy_seconds = 0.0
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+
+            self.batches += 1
+            self.requests += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+def load_sentiment_batch(num_threads):
+    from sentiment_led import SentimentModel
+    model = SentimentModel(num_threads=num_threads)
+
+    def run_batch(requests):
+        # flatten every request's texts into one forward pass, then split the labels back up
+        texts = [text for request in requests for text in request]
+        labels = model.classify(texts) if texts else []
+        results, start = [], 0
+        for request in requests:
+            results.append(labels[start:start + len(request)])
+            start += len(request)
+        return results
+
+    return run_batch
+
+def load_stt_batch(model_name, num_threads):
+    from faster_whisper import WhisperModel
+    model = WhisperModel(model_name, device="cpu", compute_type="int8", cpu_threads=num_threads)
+
+    def run_batch(requests):
+        results = []
+        for audio in requests:
+            segments, _ = model.transcribe(audio, language="en", beam_size=5)
+            results.append(" ".join(segment.text for segment in segments).strip())
+        return results
+
+    return run_batch
+
+def load_tts_batch(model_path):
+    from piper.voice import PiperVoice
+    voice = PiperVoice.load(model_path)
+
+    def run_batch(requests):
+        results = []
+        for text in requests:
+            buffer = io.BytesIO()
+            with wave.open(buffer, 'wb') as wav_file:
+                voice.synthesize(text, wav_file, sentence_silence=0.75)
+            results.append(buffer.getvalue())
+        return results
+
+    return run_batch
+
+class InferenceServer:
+    def __init__(self, batchers):
+        self.batchers = batchers
+
+    async def dispatch(self, request, payload):
+        op = request.get("op")
+        if op == "stats":
+            return {"stats": {name: b.stats() for name, b in self.batchers.items()}}, b""
+        if op not in self.batchers:
+            return {"error": f"model not loaded: {op}"}, b""
+
+        if op == "sentiment":
+            return {"labels": await self.batchers[op].submit(request["texts"])}, b""
+        if op == "stt":
+            audio = np.frombuffer(payload, dtype=np.float32)
+            return {"text": await self.batchers[op].submit(audio)}, b""
+        if op == "tts":
+            return {}, await self.batchers[op].submit(request["text"])
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                payload = await reader.readexactly(request.get("length", 0))
+                try:
+                    response, data = await self.dispatch(request, payload)
+                except Exception as e:
+                    response, data = {"error": f"{type(e).__name__}: {e}"}, b""
+                response["length"] = len(data)
+                writer.write(json.dumps(response).encode() + b"\n" + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port, ready=None):
+        for batcher in self.batchers.values():
+            asyncio.create_task(batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Inference server listening on {host}:{port} with models: {', '.join(self.batchers)}")
+        if ready is not None:
+            ready.set()
+        async with server:
+            await server.serve_forever()
+
+def build_batchers(models, args):
+    batchers = {}
+    if "sentiment" in models:
+        batchers["sentiment"] = Batcher("sentiment", load_sentiment_batch(args.threads), args.max_batch, args.max_wait)
+    if "stt" in models:
+        batchers["stt"] = Batcher("stt", load_stt_batch(args.whisper_model, args.threads), args.max_batch, args.max_wait)
+    if "tts" in models:
+        batchers["tts"] = Batcher("tts", load_tts_batch(args.piper_model), args.max_batch, args.max_wait)
+    return batchers
+
+def run_server(args, ready=None):
+    asyncio.run(InferenceServer(build_batchers(args.models, args)).serve(args.host, args.port, ready))
+
+SAMPLE_REPLIES = [
+    "What a splendid day it is to be alive",
+    "I'm afraid the news is grim, and there is little to be done about it",
+    "Blessed is he who has found his work",
+    "That is a dreadful idea and I want nothing to do with it",
+]
+
+def simulated_robot(address, models, requests, results):
+    """One fake robot: sends a reply's worth of requests to each model, like a conversation turn."""
+    client = InferenceClient(address, timeout=60.0)
+    rng = np.random.default_rng(os.getpid())
+    latencies = {model: [] for model in models}
+    for i in range(requests):
+        for model in models:
+            start = time.perf_counter()
+            if model == "sentiment":
+                client.sentiment(SAMPLE_REPLIES[:1 + i % len(SAMPLE_REPLIES)])
+            elif model == "stt":
+                client.transcribe(rng.normal(0, 0.05, 16000 * 2).astype(np.float32))
+            elif model == "tts":
+                client.synthesize(SAMPLE_REPLIES[i % len(SAMPLE_REPLIES)])
+            latencies[model].append(time.perf_counter() - start)
+    results.put(latencies)
+
+def benchmark(args):
+    """Run the server and several simulated robots on this machine and report latency and throughput."""
+    import multiprocessing
+
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_server, args=(args, ready), daemon=True)
+    server.start()
+    if not ready.wait(timeout=600):
+        raise RuntimeError("inference server didn't start")
+
+    address = f"127.0.0.1:{args.port}"
+    results = multiprocessing.Queue()
+    start = time.perf_counter()
+    robots = [
+        multiprocessing.Process(target=simulated_robot, args=(address, args.models, args.requests, results))
+        for _ in range(args.clients)
+    ]
+    for robot in robots:
+        robot.start()
+    latencies = {model: [] for model in args.models}
+    for _ in robots:
+        for model, values in results.get().items():
+            latencies[model].extend(values)
+    for robot in robots:
+        robot.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{args.clients} robots x {args.requests} turns in {elapsed:.1f} s")
+    stats = InferenceClient(address).stats()
+    for model, values in latencies.items():
+        values.sort()
+        print(f"{model:9s} {len(values) / elapsed:7.1f} req/s  "
+              f"p50 {1000 * values[len(values) // 2]:7.1f} ms  "
+              f"p95 {1000 * values[int(len(values) * 0.95) - 1]:7.1f} ms  "
+              f"mean batch {stats[model]['mean_batch_size']:.2f}")
+    server.terminate()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared inference server for a fleet of robots")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--models", nargs="+", choices=["stt", "sentiment", "tts"], default=["stt", "sentiment", "tts"])
+    parser.add_argument("--max-batch", type=int, default=16, help="most requests per batch")
+    parser.add_argument("--max-wait", type=float, default=0.01, help="seconds to wait for a batch to fill")
+    parser.add_argument("--threads", type=int, default=4, help="intra-op threads per model")
+    parser.add_argument("--whisper-model", default="base.en")
+    parser.add_argument("--piper-model", default=os.path.expanduser("~/Documents/piper/en_GB-northern_english_male-medium.onnx"))
+    parser.add_argument("--benchmark", action="store_true", help="run the server plus simulated robots locally")
+    parser.add_argument("--clients", type=int, default=8, help="simulated robots for --benchmark")
+    parser.add_argument("--requests", type=int, default=20, help="turns per simulated robot for --benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args)
+    else:
+        run_server(args)
@@ -1,204 +1,197 @@
 import multiprocessing
+from multiprocessing.managers import SyncManager
+import threading
 import time, os, signal
-from pantilthat import *
-import anthropic
 from dotenv import load_dotenv
-from RealtimeSTT import AudioToTextRecorder
+import queue
 import wave
-from piper.voice import PiperVoice
-import pyaudio
-import requests
 from pydub import AudioSegment
-from pydub.playback import play
 
-from object_tracking import get_object_tracking_processes
+from audio_levels import LevelRing, block_levels
+from hardware import create_pyaudio, create_recorder
+from inference_server import INFERENCE_SERVER, InferenceClient, InferenceUnavailable
+from turn_engine import PCMStream, TurnEngine
+
+from object_tracking import get_object_tracking_workers
 
 # Import the animation handler
 from animations import start_animation_process
 
 # Import the sentiment LED handler
-from sentiment_led import start_sentiment_led_process
+from sentiment_led import sentiment_led_handler
+
+from supervisor import Supervisor, Worker, beat
+import attention
+import telemetry
 
 load_dotenv()
 
-ANTHROPIC_API_URL = "https://api.anthropic.com/v1/complete"
-prompt_history = []
 running = multiprocessing.Value('b', True)  # Use a multiprocessing.Value for running
 audio_queue = multiprocessing.Queue()  # Queue to manage TTS audio playback
-sentiment_queue = multiprocessing.Queue() # Queue for text to analyze sentiment of
-
-# Piper TTS Setup
-USE_LOCAL_TTS = False
-if USE_LOCAL_TTS:
-    voicedir = os.path.expanduser('~/Documents/piper/')
-    model = voicedir + "en_GB-northern_english_male-medium.onnx"
-    voice = PiperVoice.load(model)
-
-# Face tracking variables
-FRAME_W = 640
-FRAME_H = 480
-CAMERA_VERTICAL_FOV = 62.2
-CAMERA_HORIZONTAL_FOV = 48.8
-cam_pan = 0
-cam_tilt = 90
-
-def call_llm_api(prompt):
-    global prompt_history
-    client = anthropic.Anthropic()
-
-    system_prompt = (
-        "The assistant is integrated into a robot that communicates through a Raspberry Pi device. "
-        "Text from the robot's microphone is passed to the assistant via the Anthropic API. "
-        "The assistant may also be passed some parsed visual cues as text. The robot has an integrated camera and face tracking device. "
-        "The assistant is named Thomas MacLarlyle. It thinks and speaks in the style of Thomas Carlyle. "
-        "Keeps things short and conversational. Brevity is favored, to allow an interactive exchange. The assistant replies in one or two sentences unless a longer monologue is warranted. "
-        "Note that because voice transcription is being done with a simple Whisper model before the text is passed to the assistant, there may be some errors in the text transcription. Buest guesses should be used as to the intention of the speaker."
-    )
-
-    new_prompt_series = prompt_history + [
-        {
-            "role": "user",
-            "content": prompt
-        }
-    ]
-
-    message = client.messages.create(
-        model="claude-3-5-sonnet-20240620",
-        max_tokens=1000,
-        temperature=0,
-        system=system_prompt,
-        messages=new_prompt_series
+pcm_queue = multiprocessing.Queue()  # Queue of (stream_id, chunk) for TTS audio streamed as raw PCM
+sentiment_queue = multiprocessing.Queue() # Queue for (reply_id, sentences) to analyze sentiment of
+speech_events = multiprocessing.Queue()  # Queue of (reply_id, sentence_index) as each sentence starts playing
+AUDIO_BLOCK_FRAMES = 1024  # Frames per block written to the output stream
+PCM_CHUNK_TIMEOUT = 5.0  # Seconds to wait for the next chunk of a PCM stream before giving up on it, well under the heartbeat timeout
+turn_counter = multiprocessing.Value('q', 0)  # Id of the latest conversation turn, so stale results can be dropped
+cancel_before = multiprocessing.Value('q', 0)  # Audio from turns with a lower id has been cancelled
+
+# Per-worker scheduling for the Pi's four cores: (cpus, nice increment, heartbeat timeout in seconds).
+# Speech recognition and playback get their own cores and normal priority; the vision preview
+# and sentiment model share a core at lower priority. Speech recognition blocks while waiting
+# for speech, so it's only restarted if it exits.
+WORKER_SCHEDULING = {
+    "listener": ({2, 3}, 0, None),
+    "audio_player": ({1}, 0, 10.0),
+    "animation": ({1}, 5, 10.0),
+    "control_loop": ({1}, 0, 10.0),
+    "vision": ({0}, 10, 10.0),
+    "sentiment": ({0}, 10, 10.0),
+}
+
+# Shared inference server for STT, if configured; the recorder's own model is the fallback.
+# Each utterance is transcribed on its own thread; the client serializes their requests.
+inference_client = InferenceClient() if INFERENCE_SERVER else None
+
+def play_blocks(p, blocks, sample_width, channels, rate, levels, cancelled):
+    """
+    Write PCM blocks to an output stream, publishing each block's level as it plays.
+    Stops early once `cancelled()` returns True.
+    """
+    stream = p.open(
+        format=p.get_format_from_width(sample_width),
+        channels=channels,
+        rate=rate,
+        output=True
     )
-    prompt_history = new_prompt_series + [
-        {
-            "role": "assistant",
-            "content": message.content
-        }
-    ]
-
-    return message.content
-
-def text_to_speech(text):
-    """Convert text to speech and play it back."""
-    sentences = text.split('. ')
-
-    if USE_LOCAL_TTS:
-        # Use the Piper TTS model
-        for i, sentence in enumerate(sentences):
-            if sentence.strip():
-                wav_file_path = f'output_{i}.wav'
-                with wave.open(wav_file_path, 'w') as wav_file:
-                    voice.synthesize(sentence.strip(), wav_file, sentence_silence=0.75)
-                audio_queue.put(wav_file_path)
-
-    else:
-        # Use the Eleven Labs API
-        voice_id = 'ZQe5CZNOzWyzPSCn5a3c' # "George"
-        headers = {
-            "Accept": "audio/mpeg",
-            "xi-api-key": os.getenv("ELEVEN_LABS_API_KEY"),
-            "Content-Type": "application/json"
-        }
-
-        for i, sentence in enumerate(sentences):
-            if sentence.strip():
-                file_path = f'output_{i}.mp3'
-
-                payload = {
-                    "text": sentence.strip(),
-                    "voice_settings": {
-                        "stability": 0.5,
-                        "similarity_boost": 0.7
-                    },
-                    "model_id": "eleven_turbo_v2"
-                }
-
-                response = requests.post(
-                    f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}",
-                    headers=headers,
-                    json=payload
-                )
-
-                if response.status_code == 200:
-                    # Save the response content (audio data) to an MP3 file
-                    with open(file_path, 'wb') as mp3_file:
-                        mp3_file.write(response.content)
-
-                    # Put the MP3 file path in the queue if needed
-                    audio_queue.put(file_path)
-                else:
-                    print(f"Error: {response.status_code} - {response.text}")
 
-def audio_player(context, running, state):
+    try:
+        for data in blocks:
+            if cancelled():
+                print("Playback cancelled.")
+                break
+            stream.write(data)
+            beat()  # a clip can play for longer than the heartbeat timeout
+            levels.publish(*block_levels(data, sample_width))
+            telemetry.inc("audio_blocks_total")
+    finally:
+        # Stop and close the stream
+        stream.stop_stream()
+        stream.close()
+
+        # Drop the level meter back to silence between clips
+        levels.publish(0.0, 0.0)
+
+def play_audio_file(p, audio_file_path, levels, cancelled):
+    """Play a WAV or MP3 file in blocks."""
+    # Check the file extension
+    file_extension = os.path.splitext(audio_file_path)[1].lower()
+
+    if file_extension == '.wav':
+        # Handling WAV file playback, read in chunks
+        with wave.open(audio_file_path, 'rb') as wf:
+            blocks = iter(lambda: wf.readframes(AUDIO_BLOCK_FRAMES), b'')
+            play_blocks(p, blocks, wf.getsampwidth(), wf.getnchannels(), wf.getframerate(), levels, cancelled)
+
+    elif file_extension == '.mp3':
+        # Decode the MP3 with pydub, then stream the PCM through PyAudio in
+        # memoryview slices so levels can be published per block
+        audio = AudioSegment.from_file(audio_file_path, format="mp3")
+        pcm = memoryview(audio.raw_data)
+        block_bytes = AUDIO_BLOCK_FRAMES * audio.frame_width
+        blocks = (pcm[i:i + block_bytes] for i in range(0, len(pcm), block_bytes))
+        play_blocks(p, blocks, audio.sample_width, audio.channels, audio.frame_rate, levels, cancelled)
+
+def play_pcm_stream(p, stream, levels, cancelled):
+    """Play a TTS clip streamed as raw PCM chunks, starting with the first chunk."""
+    def blocks():
+        waited = 0.0
+        while not cancelled():
+            # wait in short steps so the heartbeat keeps going while the stream is slow
+            beat()
+            try:
+                stream_id, chunk = pcm_queue.get(timeout=0.5)
+            except queue.Empty:
+                waited += 0.5
+                if waited >= PCM_CHUNK_TIMEOUT:
+                    print(f"PCM stream {stream.stream_id} stalled.")
+                    return
+                continue
+            waited = 0.0
+            if stream_id != stream.stream_id:
+                # leftover chunks from a stream that was skipped or cut short
+                continue
+            if chunk is None:
+                return
+            yield chunk
+
+    play_blocks(p, blocks(), stream.sample_width, stream.channels, stream.rate, levels, cancelled)
+
+def audio_player(context, running, state, levels):
     """Play audio files from the queue sequentially."""
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    p = pyaudio.PyAudio()
+    p = create_pyaudio()
 
+    playing = False
     try:
         while running.value or not audio_queue.empty():
-            if not audio_queue.empty():
-                state.value = "speaking"
+            beat()
+            try:
+                # block instead of polling; the player shares its core with the control loop
+                audio_file_path, reply_id, sentence_index = audio_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            state.value = "speaking"
+            if not playing:
+                playing = True
                 context.is_playing_audio = True
+                attention.set_speaking(True)
 
-                audio_file_path = audio_queue.get()
-                print(f"Playing audio file: {audio_file_path}. context.is_playing_audio: {context.is_playing_audio}")
-
-                # Check the file extension
-                file_extension = os.path.splitext(audio_file_path)[1].lower()
+            def cancelled():
+                # a newer utterance or shutdown cancelled this clip's turn
+                return reply_id < cancel_before.value or not running.value
 
-                if file_extension == '.wav':
-                    # Handling WAV file playback
-                    wf = wave.open(audio_file_path, 'rb')
-
-                    # Open a stream
-                    stream = p.open(
-                        format=p.get_format_from_width(wf.getsampwidth()),
-                        channels=wf.getnchannels(),
-                        rate=wf.getframerate(),
-                        output=True
-                    )
-
-                    # Read data in chunks
-                    data = wf.readframes(1024)
-
-                    # Play the sound by writing the audio data to the stream
-                    while data:
-                        stream.write(data)
-                        data = wf.readframes(1024)
-
-                    # Stop and close the stream
-                    stream.stop_stream()
-                    stream.close()
+            if cancelled():
+                print(f"Skipping audio file from cancelled turn: {audio_file_path}")
+            else:
+                print(f"Playing audio file: {audio_file_path}")
 
-                    # Close the file
-                    wf.close()
+                # Let the sentiment LEDs follow along sentence by sentence
+                speech_events.put((reply_id, sentence_index))
 
-                elif file_extension == '.mp3':
-                    # Handling MP3 file playback using pydub
-                    audio = AudioSegment.from_file(audio_file_path, format="mp3")
-                    play(audio)
+                if isinstance(audio_file_path, PCMStream):
+                    play_pcm_stream(p, audio_file_path, levels, cancelled)
+                else:
+                    play_audio_file(p, audio_file_path, levels, cancelled)
 
+            if not isinstance(audio_file_path, PCMStream):
                 # Remove the audio file after playing
                 print(f"Removing audio file: {audio_file_path}. Queue empty: {audio_queue.empty()}")
                 os.remove(audio_file_path)
 
-                if running.value:
-                    # set state to idle until listener starts back up
-                    state.value = "idle"
+            if running.value:
+                # set state to idle until listener starts back up
+                state.value = "idle"
 
             # Clear the flag when audio finishes playing
-            if audio_queue.empty() and context.is_playing_audio:
+            if audio_queue.empty():
+                playing = False
                 context.is_playing_audio = False
+                attention.set_speaking(False)
 
     finally:
         p.terminate()  # Make sure PyAudio is properly terminated
         context.is_playing_audio = False  # Ensure the flag is clear if the loop ends
+        attention.set_speaking(False)
         state.value = "idle"
 
-def handle_transcription(context, text, state, sentiment_queue):
+def handle_transcription(context, text, engine):
+    telemetry.inc("transcriptions_total")
     print(f"\nReal-time transcription: {text}.\nis_playing_audio: {context.is_playing_audio}\n")
 
-    # don't get another response while the audio from the previous response is playing
+    # don't get another response while the audio from the previous response is playing;
+    # without echo cancellation the robot would hear itself, so there's no barge-in
     if context.is_playing_audio:
         print("Audio is playing. Skipping transcription.")
         return
@@ -207,48 +200,109 @@ def handle_transcription(context, text, state, sentiment_queue):
     if text == 'Thank you.': return
     if text.strip() == '': return
 
-    state.value = "thinking"
-
-    response = call_llm_api(text)
-    print(f"\nLLM Response: {response}")
-
-    response_text = '. '.join([r.text for r in response])
-
-    # Send the response for sentiment analyis
-    sentiment_queue.put(response_text)
-
-    # Convert the response text to speech and queue up audio
-    text_to_speech(response_text)
+    # Start a new turn; this cancels any turn that is still in flight
+    engine.submit(text)
+
+def remote_text(recorder, on_transcription_finished):
+    """
+    Like `recorder.text`, but transcribe the recorded utterance on the inference server,
+    falling back to the recorder's own model if the server can't be reached.
+
+    Transcription finishes before this returns: the fallback reads `recorder.audio`, which
+    the next wait overwrites.
+    """
+    recorder.interrupt_stop_event.clear()
+    recorder.was_interrupted.clear()
+    recorder.wait_audio()
+    if recorder.is_shut_down:
+        return
+    if recorder.interrupt_stop_event.is_set():
+        # aborted by the attention watcher; let `abort()` return, as `recorder.text` does
+        recorder.was_interrupted.set()
+        return
 
-    # After thinking, set state back to idle
-    if state.value != "speaking":  # Prevent overriding 'speaking' state
-        state.value = "idle"
+    try:
+        text = inference_client.transcribe(recorder.audio)
+    except InferenceUnavailable:
+        text = recorder.transcribe()
+    on_transcription_finished(text)
 
 def listen_to_audio(context, running, state, sentiment_queue):
     signal.signal(signal.SIGINT, signal.SIG_IGN)
-    recorder = AudioToTextRecorder(model='tiny.en')
+    recorder = create_recorder(model='tiny.en')
     recorder_started = False  # Track whether the recorder has started
 
+    # LLM, TTS and playback hand-off run asynchronously, so the recorder is never blocked
+    engine = TurnEngine(state, running, sentiment_queue, audio_queue, pcm_queue, turn_counter, cancel_before)
+    engine.start()
+
     def transcribe(text):
-        return handle_transcription(context, text, state, sentiment_queue)
+        return handle_transcription(context, text, engine)
+
+    # Waiting for an utterance blocks, so a watcher aborts the wait when the face is lost
+    waiting = threading.Event()
+
+    def abort_wait():
+        # `abort()` blocks until the wait acknowledges it, which never happens if the wait
+        # returned just before; run it on its own thread so the watcher can't hang
+        aborting = threading.Thread(target=recorder.abort, daemon=True)
+        aborting.start()
+        aborting.join(timeout=2.0)
+        if aborting.is_alive():
+            print("Recorder wait had already finished; abort skipped.")
+
+    def watch_attention():
+        while running.value:
+            if waiting.is_set() and not attention.listening_attentive():
+                waiting.clear()
+                abort_wait()
+            time.sleep(0.5)
+
+        # shutting down: wake the main loop if it's waiting for an utterance
+        if waiting.is_set():
+            waiting.clear()
+            abort_wait()
+
+    threading.Thread(target=watch_attention, daemon=True).start()
+    savings = attention.CpuSavings("listener_cpu_seconds_saved_total", include_children=True)
 
     try:
         while running.value:
-            if context.is_playing_audio:
+            attentive = attention.listening_attentive()
+            # time spent paused for playback isn't a saving from gating
+            savings.sample(None if context.is_playing_audio else not attentive)
+            telemetry.set_value("listener_gated", int(not attentive))
+
+            if context.is_playing_audio or not attentive:
                 if recorder_started:
-                    print("Stopping recorder.")
-                    recorder.stop()  # Explicitly stop the recorder if audio is playing
+                    # Explicitly stop the recorder if audio is playing or nobody is there
+                    print("Stopping recorder." if attentive else "No face seen for a while. Stopping recorder.")
+                    recorder.stop()
                     recorder_started = False
+                    if not attentive:
+                        state.value = "idle"
             else:
                 if not recorder_started:
                     print("Starting recorder.")
                     recorder.start()  # Start the recorder if it hasn't been started yet
                     recorder_started = True
                     state.value = "listening"
-                recorder.text(transcribe)
+                waiting.set()
+                if inference_client is not None:
+                    remote_text(recorder, transcribe)
+                else:
+                    recorder.text(transcribe)
+                waiting.clear()
 
             time.sleep(0.1)  # Sleep briefly to avoid busy-waiting
 
+        # Let the engine cancel whatever turn is still in flight
+        engine.join(timeout=5)
+
+        # Stop the recorder's own processes rather than leaving them orphaned
+        print("Shutting down the audio recorder.")
+        recorder.shutdown()
+
     except KeyboardInterrupt:
         print("KeyboardInterrupt caught in listen_to_audio")
         if recorder_started:
@@ -257,43 +311,40 @@ def listen_to_audio(context, running, state, sentiment_queue):
         raise KeyboardInterrupt
 
 if __name__ == "__main__":
-    try:
-        manager = multiprocessing.Manager()
-        context = manager.Namespace()
-        context.is_playing_audio = False
-
-        # Create a shared state variable with listening, thinking, speaking, and idle states
-        state = manager.Value('c', "idle")  # 'c' for char array (string)
-
-        # Start the animation process
-        animation_process = multiprocessing.Process(target=start_animation_process, args=(state,))
-        animation_process.start()
-
-        # Start the sentiment LED process
-        sentiment_led_process = start_sentiment_led_process(sentiment_queue, running)
-
-        # Define other processes
-        processes = [
-            multiprocessing.Process(target=listen_to_audio, args=(context, running, state, sentiment_queue)),
-            multiprocessing.Process(target=audio_player, args=(context, running, state)),
-        ]
+    # The manager ignores Ctrl+C so shared state stays available while workers shut down
+    manager = SyncManager()
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    context = manager.Namespace()
+    context.is_playing_audio = False
+
+    # Create a shared state variable with listening, thinking, speaking, and idle states
+    state = manager.Value('c', "idle")  # 'c' for char array (string)
+
+    # Shared-memory ring of playback levels, written by the audio player and read by the animation
+    levels = LevelRing()
+
+    worker_args = [
+        ("animation", start_animation_process, (state, levels, running)),
+        ("sentiment", sentiment_led_handler, (sentiment_queue, speech_events, running)),
+        ("listener", listen_to_audio, (context, running, state, sentiment_queue)),
+        ("audio_player", audio_player, (context, running, state, levels)),
+    ]
+    worker_args += get_object_tracking_workers(running)
 
-        processes += get_object_tracking_processes(manager)
+    workers = [
+        Worker(name, target, args, *WORKER_SCHEDULING.get(name, (None, 0, None)))
+        for (name, target, args) in worker_args
+    ]
 
-        for process in processes:
-            process.start()
+    supervisor = Supervisor(workers, running)
 
-        for process in processes:
-            process.join()
+    # Prometheus endpoint for queue depths, loop rates and per-worker load
+    telemetry.MetricsServer({"audio": audio_queue, "pcm": pcm_queue, "sentiment": sentiment_queue}, workers).start()
 
-        # Join the sentiment LED process
-        sentiment_led_process.join()
+    # Runs until Ctrl+C, restarting any worker that crashes or hangs
+    supervisor.run()
 
-    except KeyboardInterrupt:
-        print("\nGracefully stopping...")
-        running.value = False
-        context.is_playing_audio = False  # Clear the flag if stopping
-        state.value = "idle"  # Set state to idle
-        print("Stopped all processes. Exiting.")
-        time.sleep(0.5)
-        os._exit(1)
+    context.is_playing_audio = False  # Clear the flag if stopping
+    state.value = "idle"  # Set state to idle
+    manager.shutdown()
+    print("Stopped all processes. Exiting.")
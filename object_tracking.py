@@ -1,87 +1,167 @@
-from multiprocessing import Manager, Process
-from picamera2 import Picamera2
+import multiprocessing
+from multiprocessing import Process
+from image_search.feedforward import AxisCalibration, FeedForwardPID
 from image_search.object_center import ObjectCenter
-from image_search.pid import PID
-from adafruit_servokit import ServoKit
-from PIL import Image, ImageDraw, ImageFont, ImageTk
+from image_search.pid import PAN_GAINS, PID, START_ANGLES, TILT_GAINS
+from hardware import HAS_DISPLAY, create_camera, create_servo_kit
+from supervisor import beat
+import attention
+import telemetry
+from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import pkg_resources
+import math
 import os
 import signal
 import time
-import tkinter as tk
 
 
 servo_range = (0, 180)
-servo_kit = ServoKit(channels=16)
-
-# handle a keyboard interrupt
-def signal_handler(sig, frame):
-    # print a status message
-    print("[INFO] You pressed `ctrl + c`! Exiting...")
-
-    # disable the servos
-    servo_kit.servo[0].angle = 90
-    servo_kit.servo[1].angle = 180
-
-    # exit
-    os._exit(1)
-
-def find_object_center(args, obj_x, obj_y, center_x, center_y):
+servo_kit = create_servo_kit()
+
+# Camera modes: full resolution and rate while someone is there, reduced otherwise
+FRAME_SIZE = (640, 480)
+REDUCED_FRAME_SIZE = (320, 240)
+REDUCED_FPS = 5
+
+# Large errors are corrected by jumping straight to the face's angle, computed from the
+# camera's field of view, and the PID only does fine tracking. Set ROBOT_TRACKING_MODE=pid
+# to track with the PID alone. Calibrate degrees per unit with
+# image_search.feedforward.measure_degrees_per_unit.
+TRACKING_MODE = os.getenv("ROBOT_TRACKING_MODE", "feedforward")
+CAMERA_HORIZONTAL_FOV = float(os.getenv("ROBOT_CAMERA_HFOV", "62.2"))  # Pi camera v2
+CAMERA_VERTICAL_FOV = float(os.getenv("ROBOT_CAMERA_VFOV", "48.8"))
+PAN_DEGREES_PER_UNIT = float(os.getenv("ROBOT_PAN_DEGREES_PER_UNIT", "1.0"))
+TILT_DEGREES_PER_UNIT = float(os.getenv("ROBOT_TILT_DEGREES_PER_UNIT", "1.0"))
+JUMP_THRESHOLD = float(os.getenv("ROBOT_JUMP_THRESHOLD", "5.0"))  # Degrees of error that trigger a jump
+SERVO_SPEED = 400.0  # Degrees per second, used to know when a jump has landed
+
+def park_servos():
+    """Return the servos to their resting position."""
+    print("[INFO] Parking the servos.")
+    (pan_angle, tilt_angle) = START_ANGLES
+    servo_kit.servo[0].angle = pan_angle
+    servo_kit.servo[1].angle = tilt_angle
+
+def find_object_center(args, detection, new_frame, running):
     signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ignore SIGINT in the child process
 
     # Initialize the camera
-    cam = Picamera2()
-    cam.configure(cam.create_preview_configuration(main={"format": "XRGB8888", "size": (640, 480)}))
+    cam = create_camera()
+    cam.configure(cam.create_preview_configuration(main={"format": "XRGB8888", "size": FRAME_SIZE}))
     cam.start()
     time.sleep(1)
 
-    # Initialize Tkinter in the main process
-    tk_root = tk.Tk()
-    tk_root.title("Pi Camera Stream")
-    label = tk.Label(tk_root)
-    label.pack()
-
     # Initialize the object center finder
-    obj = ObjectCenter(args["cascade"])
-    fnt = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", 16)
+    obj = ObjectCenter(args["cascade"], full_width=FRAME_SIZE[0])
+
+    # Start at full effort, as if a face had just been seen
+    attention.saw_face()
+    savings = attention.CpuSavings("vision_cpu_seconds_saved_total")
+    camera_mode = {"reduced": False, "next_frame": 0.0}
+
+    def set_camera_mode(reduced):
+        size = REDUCED_FRAME_SIZE if reduced else FRAME_SIZE
+        print(f"[INFO] Camera at {size[0]}x{size[1]}" + (f", {REDUCED_FPS} fps" if reduced else ", full frame rate"))
+        cam.stop()
+        cam.configure(cam.create_preview_configuration(main={"format": "XRGB8888", "size": size}))
+        cam.start()
+        camera_mode["reduced"] = reduced
+        telemetry.set_value("vision_reduced", int(reduced))
+
+    preview = args.get("preview", True)
+    try:
+        fnt = ImageFont.truetype("Pillow/Tests/fonts/FreeMono.ttf", 16)
+    except OSError:
+        fnt = ImageFont.load_default()
+
+    # Capture and process one frame, returning the annotated preview image if enabled
+    def process_frame():
+        beat()
+
+        reduced = attention.vision_reduced()
+        savings.sample(reduced)
+        if reduced != camera_mode["reduced"]:
+            set_camera_mode(reduced)
+        if reduced:
+            # pace the reduced frame rate
+            delay = camera_mode["next_frame"] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            camera_mode["next_frame"] = max(time.time(), camera_mode["next_frame"]) + 1.0 / REDUCED_FPS
 
-    # Function to update the frame
-    def update_frame():
         # Capture frame from the camera
         frame = cam.capture_array()
+        captured_at = time.time()
         frame = np.flipud(frame)  # Flip vertically without OpenCV
-        pil_image = Image.fromarray(frame)
-        draw = ImageDraw.Draw(pil_image)
+        telemetry.inc("vision_frames_total")
 
-        # Calculate the center of the frame
+        # Positions are always published in full resolution pixels, so the PID gains
+        # hold in both camera modes
         (H, W) = frame.shape[:2]
-        center_x.value = W // 2
-        center_y.value = H // 2
-        draw.rectangle([center_x.value-1, center_y.value-1, center_x.value + 2, center_y.value + 2], fill="blue")
+        scale = FRAME_SIZE[0] / W
 
         # Find the object's location
-        objectLoc = obj.update(frame, (center_x.value, center_y.value))
+        objectLoc = obj.update(frame, (W // 2, H // 2))
 
         if objectLoc is not None:
             ((objX, objY), rect) = objectLoc
-            obj_x.value = objX
-            obj_y.value = objY
+            attention.saw_face(obj.last_seen)
+            publish_detection(detection, objX * scale, objY * scale, captured_at)
 
+            # wake the control loop for this detection
+            new_frame.set()
+            telemetry.inc("vision_detections_total")
+
+        # if a face wasn't found, clear the position to prevent PID errors from accumulating
+        else:
+            publish_detection(detection, math.nan, math.nan, captured_at)
+
+        if not preview:
+            return None
+
+        pil_image = Image.fromarray(frame)
+        draw = ImageDraw.Draw(pil_image)
+        draw.rectangle([W // 2 - 1, H // 2 - 1, W // 2 + 2, H // 2 + 2], fill="blue")
+
+        if objectLoc is not None:
             # Draw the object on the frame (uncomment if you have drawing code)
             if rect is not None:
                 (x, y, w, h) = rect
                 draw.rectangle([x, y, x + w, y + h], outline="green", width=2)
 
-            draw.rectangle([obj_x.value-1, obj_y.value-1, obj_x.value + 2, obj_y.value + 2], fill="red")
-            draw.text((10, H - 60), f"Center: ({center_x.value}, {center_y.value})", font=fnt, fill="white")
-            draw.text((10, H - 40), f"Object: ({obj_x.value}, {obj_y.value})", font=fnt, fill="white")
-            draw.text((10, H - 20), f"Diff:   ({obj_x.value - center_x.value}, {obj_y.value - center_y.value})", font=fnt, fill="white")
+            draw.rectangle([objX-1, objY-1, objX + 2, objY + 2], fill="red")
+            draw.text((10, H - 60), f"Center: ({W // 2}, {H // 2})", font=fnt, fill="white")
+            draw.text((10, H - 40), f"Object: ({objX}, {objY})", font=fnt, fill="white")
+            draw.text((10, H - 20), f"Diff:   ({objX - W // 2}, {objY - H // 2})", font=fnt, fill="white")
 
-        # if a face wasn't found, set the object coords to none to prevent PID errors from accumulating
-        else:
-            obj_x.value = None
-            obj_y.value = None
+        return pil_image
+
+    # Without a screen there's nothing to show, so just process frames as they arrive
+    if not preview:
+        try:
+            while running.value:
+                process_frame()
+        finally:
+            cam.stop()
+        return
+
+    import tkinter as tk
+    from PIL import ImageTk
+
+    # Initialize Tkinter in the main process
+    tk_root = tk.Tk()
+    tk_root.title("Pi Camera Stream")
+    label = tk.Label(tk_root)
+    label.pack()
+
+    # Function to update the frame
+    def update_frame():
+        if not running.value:
+            tk_root.destroy()
+            return
+
+        pil_image = process_frame()
 
         # Convert the frame to an ImageTk object
         image = ImageTk.PhotoImage(pil_image)
@@ -96,118 +176,155 @@ def find_object_center(args, obj_x, obj_y, center_x, center_y):
     update_frame()
 
     # Start the Tkinter mainloop
-    tk_root.mainloop()
-
-def pid_process(output, p, i, d, obj_coord, center_coord):
-    """
-    Run a PID control loop to maintain the object in the center of the frame.
+    try:
+        tk_root.mainloop()
+    finally:
+        cam.stop()
+
+def publish_detection(detection, x, y, captured_at):
+    """Publish a face position (NaN when lost) and its frame's capture time together."""
+    with detection.get_lock():
+        detection[0] = x
+        detection[1] = y
+        detection[2] = captured_at
+
+def control_loop(detection, new_frame, running, pan_gains, tilt_gains, start_angles, report_every=100):
     """
-    p = PID(p, i, d)
-    p.initialize()
-
-    angle = output.value
-
-    # loop indefinitely
-    while True:
-        time.sleep(0.05)
+    Run a single pan/tilt control loop that wakes whenever a new detection arrives,
+    updates both axes together, and writes the servos directly. Each axis jumps to the
+    face's computed angle when it's far off-center, and uses its PID otherwise.
 
-        # calculate the error
-        error = (obj_coord.value or 0) - (center_coord.value or 0)
-
-        # I tried returning before the `error` calculation, but occasionally one of these values
-        # comes out to none when `error` is calculated. TODO look to see if the state isn't being managed correctly
-        if obj_coord.value is None or center_coord.value is None:
-            continue
-
-        # update the value
-        adjustment = p.update(error)
-        angle = max(servo_range[0], min(servo_range[1], angle + adjustment))
+    `detection` holds the face's (x, y) in full resolution pixels and the time.time() at
+    which its frame was captured, so the loop can measure frame-to-actuation latency.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor handles Ctrl+C; we stop when `running` clears
+
+    jump_threshold = JUMP_THRESHOLD if TRACKING_MODE == "feedforward" else math.inf
+    pan_pid = FeedForwardPID(
+        PID(*pan_gains),
+        AxisCalibration(FRAME_SIZE[0], CAMERA_HORIZONTAL_FOV, PAN_DEGREES_PER_UNIT),
+        jump_threshold,
+        SERVO_SPEED
+    )
+    tilt_pid = FeedForwardPID(
+        PID(*tilt_gains),
+        AxisCalibration(FRAME_SIZE[1], CAMERA_VERTICAL_FOV, TILT_DEGREES_PER_UNIT),
+        jump_threshold,
+        SERVO_SPEED
+    )
+    pan_pid.initialize()
+    tilt_pid.initialize()
+
+    (pan_angle, tilt_angle) = start_angles
+    pan_to(pan_angle)
+    tilt_to(tilt_angle)
+
+    # the frame center never changes; detections are scaled to full resolution
+    (cx, cy) = (FRAME_SIZE[0] // 2, FRAME_SIZE[1] // 2)
+
+    latencies = []
+
+    try:
+        while running.value:
+            beat()
+
+            # block until the vision process publishes a detection; the timeout lets us
+            # re-initialize the PIDs when the face has been lost for a while
+            if not new_frame.wait(timeout=1.0):
+                pan_pid.initialize()
+                tilt_pid.initialize()
+                continue
+            new_frame.clear()
+
+            # read the position and capture time as one consistent detection
+            with detection.get_lock():
+                (x, y, captured_at) = detection[:]
+
+            # the vision process sets the coordinates to NaN when the face is lost
+            if math.isnan(x) or math.isnan(y):
+                continue
+
+            # update both axes from the same detection
+            pan_angle = clamp_to_servo_range(pan_angle + pan_pid.update(x - cx, captured_at=captured_at))
+            tilt_angle = clamp_to_servo_range(tilt_angle + tilt_pid.update(y - cy, captured_at=captured_at))
 
-        output.value = angle
+            pan_to(pan_angle)
+            tilt_to(tilt_angle)
+
+            latency = time.time() - captured_at
+            telemetry.inc("pid_updates_total")
+            telemetry.set_value("control_latency_seconds", latency)
+
+            latencies.append(latency)
+            if len(latencies) >= report_every:
+                latencies.sort()
+                mean = sum(latencies) / len(latencies)
+                p95 = latencies[int(len(latencies) * 0.95) - 1]
+                print(f"[INFO] Frame-to-actuation latency: mean {mean * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms. "
+                      f"Jumps so far: pan {pan_pid.jumps}, tilt {tilt_pid.jumps}")
+                latencies = []
+    finally:
+        park_servos()
+
+def clamp_to_servo_range(angle):
+    return max(servo_range[0], min(servo_range[1], angle))
 
 def in_servo_range(val, start, end):
     # determine the input value is in the range start to end
     return (val >= start and val <= end)
 
-def set_servos(pan, tilt):
-    # signal trap to handle keyboard interrupt
-    signal.signal(signal.SIGINT, signal_handler)
-
-    last_pan_value = pan.value
-
-    while True:
-        pan_angle = pan.value
-        tilt_angle = tilt.value
-
-        # if the pan angle is within the range, pan
-        if in_servo_range(pan_angle, servo_range[0], servo_range[1]):
-            pan_to(pan_angle)
-
-        # if the tilt angle is within the range, tilt
-        if in_servo_range(tilt_angle, servo_range[0], servo_range[1]):
-            tilt_to(tilt_angle + 0)
-
-        last_pan_value += pan_angle
-
 def pan_to(angle):
     servo_kit.servo[0].angle = angle
+    telemetry.inc("servo_writes_total")
 
 def tilt_to(angle):
     servo_kit.servo[1].angle = angle
+    telemetry.inc("servo_writes_total")
 
-def get_object_tracking_processes(manager):
+def get_object_tracking_workers(running):
     """
-    This function returns the processes for object/face tracking, which include:
+    This function returns (name, target, args) for each object/face tracking process:
     1. finds the object center
-    2. determines the panning angle
-    3. determines the tilting angle
-    4. sets the pan and tilt servos
+    2. runs the pan/tilt PID control loop and sets the servos
 
-    This function doesn't start or join the processes, but leaves that up to the caller.
+    This function doesn't create or start the processes, but leaves that up to the caller.
+    The shared detection is plain shared memory, so the per-frame hand-off never goes
+    through a manager process.
     """
     haar_path = pkg_resources.resource_filename('cv2', 'data/haarcascade_frontalface_default.xml')
 
-    # set the initial values for the object center and pan/tilt
-    center_x = manager.Value('i', 0)
-    center_y = manager.Value('i', 0)
-
-    # set the object's (x, y)-coordinates
-    obj_x = manager.Value('i', 0)
-    obj_y = manager.Value('i', 0)
-
-    # pan and tilt values will be managed by independent PIDs
-    pan = manager.Value('i', 90)
-    tilt = manager.Value('i', 180)
-    pan_to(pan.value)
-    tilt_to(tilt.value)
-
-    # set PID values
-    pan_p = 0.0125
-    pan_i = 0.0005
-    pan_d = 0.001
-
-    tilt_p = 0.005
-    tilt_i = 0.001
-    tilt_d = 0.001
-
-    # we have 4 processes to start:
-    # 1. find_object_center - finds the object center
-    # 2. panning            - PID control loop determines panning angle
-    # 3. tilting            - PID control loop determines tilting angle
-    # 4. set_servos         - sets the pan and tilt servos
-    processes = [
-        Process(target=find_object_center, args=({"cascade": haar_path}, obj_x, obj_y, center_x, center_y)),
-        Process(target=pid_process, args=(pan, pan_p, pan_i, pan_d, obj_x, center_x)),
-        Process(target=pid_process, args=(tilt, tilt_p, tilt_i, tilt_d, obj_y, center_y)),
-        Process(target=set_servos, args=(pan, tilt))
+    # the latest detection: (x, y, capture time), written and read under its lock,
+    # and the event that signals its arrival
+    detection = multiprocessing.Array('d', [math.nan, math.nan, 0.0])
+    new_frame = multiprocessing.Event()
+
+    # we have 2 processes to start:
+    # 1. find_object_center - finds the object center and signals each new detection
+    # 2. control_loop       - updates pan and tilt PIDs together and sets the servos
+    return [
+        ("vision", find_object_center, ({"cascade": haar_path, "preview": HAS_DISPLAY}, detection, new_frame, running)),
+        ("control_loop", control_loop, (detection, new_frame, running, PAN_GAINS, TILT_GAINS, START_ANGLES)),
     ]
 
-    return processes
+def get_object_tracking_processes(running):
+    """
+    This function returns the processes for object/face tracking, which run until
+    `running` is cleared.
+
+    This function doesn't start or join the processes, but leaves that up to the caller.
+    """
+    return [Process(target=target, args=args, name=name) for (name, target, args) in get_object_tracking_workers(running)]
 
 if __name__ == "__main__":
-    manager = Manager()
-    processes = get_object_tracking_processes(manager)
+    running = multiprocessing.Value('b', True)
+    processes = get_object_tracking_processes(running)
     for process in processes:
         process.start()
-    for process in processes:
-        process.join()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("[INFO] You pressed `ctrl + c`! Exiting...")
+        running.value = False
+        for process in processes:
+            process.join()
@@ -19,8 +19,10 @@ os.system('v4l2-ctl -p 40')
 # W = 160 and H = 100 are good settings if you are using and earlier Raspberry Pi Version.
 FRAME_W = 640
 FRAME_H = 480
-CAMERA_VERTICAL_FOV = 62.2
-CAMERA_HORIZONTAL_FOV = 48.8
+# The Pi camera v2 sees 62.2 degrees across its (landscape, 4:3) width and 48.8 degrees
+# across its height
+CAMERA_HORIZONTAL_FOV = 62.2
+CAMERA_VERTICAL_FOV = 48.8
 
 # Default Pan/Tilt for the camera in degrees. I have set it up to roughly point at my face location when it starts the code.
 # Camera range is from 0 to 180. Alter the values below to determine the starting point for your pan and tilt.
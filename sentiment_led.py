@@ -1,15 +1,37 @@
+import os
+import queue
+import threading
 import time
 import multiprocessing
 import torch
 from transformers import DistilBertTokenizer, DistilBertForSequenceClassification
-import board
-import busio
-from adafruit_pca9685 import PCA9685
+from hardware import create_pca9685
+from inference_server import INFERENCE_SERVER, InferenceClient, InferenceUnavailable
+from supervisor import beat
+import telemetry
 
 # LED Configuration
 LED_CHANNEL_GREEN = 2  # Green LED
 LED_CHANNEL_RED = 3  # Red LED
 
+# Sentiment model configuration
+SENTIMENT_MODEL_NAME = "distilbert-base-uncased-finetuned-sst-2-english"
+SENTIMENT_BACKEND = "quantized"  # "torch" (fp32), "quantized" (int8 dynamic) or "onnx" (ONNX Runtime)
+SENTIMENT_MAX_LENGTH = 128  # Tokens; longer replies are truncated
+SENTIMENT_NUM_THREADS = 1  # Intra-op threads, kept low so the model doesn't starve Whisper
+ONNX_MODEL_PATH = os.path.expanduser("~/.cache/audio-visual-bot/distilbert-sst2.onnx")
+
+# LED fade configuration
+LED_FADE_SECONDS = 0.3
+LED_FADE_STEPS = 15
+
+# Target (green, red) brightness for each sentiment
+SENTIMENT_COLORS = {
+    'positive': (1.0, 0.0),
+    'negative': (0.0, 1.0),
+    'neutral': (0.25, 0.25),
+}
+
 def set_led_brightness(channel, brightness, pca):
     """
     Set the brightness of an LED.
@@ -26,81 +48,225 @@ def set_led_brightness(channel, brightness, pca):
     pwm_value = int(brightness * 65535)
     pca.channels[channel].duty_cycle = pwm_value
 
+def fade_leds(targets, current, pca, duration=LED_FADE_SECONDS, steps=LED_FADE_STEPS):
+    """
+    Smoothly fade LEDs from their current brightness to the target brightness.
+
+    Parameters:
+        targets (dict): Channel number -> target brightness (0.0 to 1.0).
+        current (dict): Channel number -> current brightness; updated in place.
+        pca (PCA9685): The PCA9685 instance.
+        duration (float): Length of the fade in seconds.
+        steps (int): Number of PWM updates during the fade.
+    """
+    start = dict(current)
+    for step in range(1, steps + 1):
+        fraction = step / steps
+        for channel, target in targets.items():
+            current[channel] = start[channel] + (target - start[channel]) * fraction
+            set_led_brightness(channel, current[channel], pca)
+        time.sleep(duration / steps)
+
 def initialize_leds():
     """Initialize the I2C bus and PCA9685 for LED control."""
-    # Initialize I2C bus.
-    i2c = busio.I2C(board.SCL, board.SDA)
-
-    # Initialize PCA9685 using the I2C bus
-    pca = PCA9685(i2c)
+    pca = create_pca9685()
     pca.frequency = 1000  # Higher frequency for LEDs
 
     return pca
 
-def perform_sentiment_analysis(text, tokenizer, model):
+class SentimentModel:
+    """
+    DistilBERT sentiment classifier with a selectable inference backend.
+
+    Parameters:
+        backend (str): "torch" for the fp32 PyTorch model, "quantized" for int8 dynamic
+            quantization of the linear layers, or "onnx" for ONNX Runtime.
+        num_threads (int): Intra-op thread count for the backend.
+        max_length (int): Maximum number of tokens fed to the model.
+    """
+    def __init__(self, backend=SENTIMENT_BACKEND, num_threads=SENTIMENT_NUM_THREADS, max_length=SENTIMENT_MAX_LENGTH):
+        self.backend = backend
+        self.max_length = max_length
+        self.tokenizer = DistilBertTokenizer.from_pretrained(SENTIMENT_MODEL_NAME)
+
+        torch.set_num_threads(num_threads)
+        model = DistilBertForSequenceClassification.from_pretrained(SENTIMENT_MODEL_NAME)
+        model.eval()
+        self.id2label = {int(k): v.lower() for k, v in model.config.id2label.items()}
+
+        if backend == "torch":
+            self.model = model
+        elif backend == "quantized":
+            self.model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == "onnx":
+            import onnxruntime
+            if not os.path.exists(ONNX_MODEL_PATH):
+                export_onnx_model(model, self.tokenizer, ONNX_MODEL_PATH)
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+            self.session = onnxruntime.InferenceSession(ONNX_MODEL_PATH, options, providers=["CPUExecutionProvider"])
+        else:
+            raise ValueError(f"Unknown sentiment backend: {backend}")
+
+        # Warm-up pass so the first real reply doesn't pay for lazy initialization
+        self.classify(["Warming up the sentiment model."])
+
+    def logits(self, texts):
+        """Return the classification logits for a list of texts as a numpy array."""
+        if self.backend == "onnx":
+            inputs = self.tokenizer(texts, return_tensors="np", truncation=True, max_length=self.max_length, padding=True)
+            return self.session.run(["logits"], {
+                "input_ids": inputs["input_ids"].astype("int64"),
+                "attention_mask": inputs["attention_mask"].astype("int64"),
+            })[0]
+
+        inputs = self.tokenizer(texts, return_tensors="pt", truncation=True, max_length=self.max_length, padding=True)
+        with torch.no_grad():
+            return self.model(**inputs).logits.numpy()
+
+    def classify(self, texts):
+        """Return a 'positive' or 'negative' label for each text."""
+        return [self.id2label[int(i)] for i in self.logits(texts).argmax(axis=-1)]
+
+class RemoteSentimentModel:
+    """
+    Sentiment classifier that runs on the shared inference server. The first time the
+    server can't be reached, the local model starts loading in a background thread, so
+    the LED loop keeps its heartbeat; replies are neutral until it's ready.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.local = None
+        self.loading = None
+
+    def load_local(self):
+        print("Loading local sentiment model.")
+        self.local = SentimentModel()
+        print("Local sentiment model ready.")
+
+    def classify(self, texts):
+        beat()
+        try:
+            return self.client.sentiment(texts)
+        except InferenceUnavailable:
+            pass
+        finally:
+            beat()
+
+        if self.local is not None:
+            return self.local.classify(texts)
+        if self.loading is None:
+            self.loading = threading.Thread(target=self.load_local, daemon=True)
+            self.loading.start()
+        return ['neutral'] * len(texts)
+
+def export_onnx_model(model, tokenizer, path):
+    """Export the DistilBERT classifier to ONNX with dynamic batch and sequence axes."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    inputs = tokenizer(["An example sentence."], return_tensors="pt")
+    torch.onnx.export(
+        model,
+        (inputs["input_ids"], inputs["attention_mask"]),
+        path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=14,
+    )
+    print(f"Exported sentiment model to {path}")
+
+def perform_sentiment_analysis(text, model):
     """
     Perform sentiment analysis on the given text.
 
     Parameters:
         text (str): The text to analyze.
-        tokenizer: The tokenizer instance.
-        model: The sentiment analysis model.
+        model (SentimentModel or RemoteSentimentModel): The sentiment analysis model.
 
     Returns:
         str: 'positive', 'negative', or 'neutral'
     """
-    inputs = tokenizer(text, return_tensors="pt")
-    with torch.no_grad():
-        logits = model(**inputs).logits
+    return model.classify([text])[0]
 
-    predicted_class_id = logits.argmax().item()
-    sentiment = model.config.id2label[predicted_class_id].lower()
-    return sentiment
+def get_newest_message(sentiment_queue, timeout):
+    """
+    Wait up to `timeout` for a message, then drain any backlog so only the newest reply
+    is returned. Returns None if nothing arrived.
+    """
+    try:
+        message = sentiment_queue.get(timeout=timeout)
+    except queue.Empty:
+        return None
 
-def sentiment_led_handler(sentiment_queue, running):
+    while True:
+        try:
+            message = sentiment_queue.get_nowait()
+        except queue.Empty:
+            return message
+
+def sentiment_led_handler(sentiment_queue, speech_events, running):
     """
     Handle sentiment analysis and LED control.
 
+    Each reply arrives as (reply_id, sentences). All sentences are scored in one batched
+    forward pass, and the LEDs fade to each sentence's sentiment as `audio_player`
+    reports that the sentence has started playing.
+
     Parameters:
-        sentiment_queue (multiprocessing.Queue): Queue to receive LLM responses.
+        sentiment_queue (multiprocessing.Queue): Queue to receive (reply_id, sentences) from the LLM response.
+        speech_events (multiprocessing.Queue): Queue of (reply_id, sentence_index) playback start events.
         running (multiprocessing.Value): Shared value to control the running state.
     """
     # Initialize sentiment analysis model
-    tokenizer = DistilBertTokenizer.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english")
-    model = DistilBertForSequenceClassification.from_pretrained("distilbert-base-uncased-finetuned-sst-2-english")
+    if INFERENCE_SERVER:
+        # respond well within the worker's heartbeat timeout
+        model = RemoteSentimentModel(InferenceClient(timeout=5.0))
+    else:
+        model = SentimentModel()
 
     # Initialize LEDs
     pca = initialize_leds()
+    current = {LED_CHANNEL_GREEN: 0.0, LED_CHANNEL_RED: 0.0}
+
+    reply_id = None
+    sentiments = []
+    playing = None  # (reply_id, sentence_index) most recently reported by the audio player
+    shown = None  # (reply_id, sentence_index) currently displayed on the LEDs
 
     try:
         while running.value:
-            try:
-                # Wait for a new message with a timeout to allow checking the running flag
-                message = sentiment_queue.get(timeout=0.5)
-            except:
-                continue  # Timeout occurred, loop back to check running flag
-
-            sentiment = perform_sentiment_analysis(message, tokenizer, model)
-            print(f"Sentiment Analysis Result: {sentiment}")
-
-            if sentiment == 'positive':
-                # Light Green LED
-                print("Lighting Green LED")
-                set_led_brightness(LED_CHANNEL_GREEN, 1.0, pca)  # Full brightness
-                set_led_brightness(LED_CHANNEL_RED, 0.0, pca)  # Off
-            elif sentiment == 'negative':
-                # Light Red LED
-                print("Lighting Red LED")
-                set_led_brightness(LED_CHANNEL_GREEN, 0.0, pca)  # Off
-                set_led_brightness(LED_CHANNEL_RED, 1.0, pca)  # Full brightness
-            else:
-                # Optional: Handle neutral or other sentiments
-                print("Lighting Red and Green LEDs at 25% brightness")
-                set_led_brightness(LED_CHANNEL_GREEN, 0.25, pca)
-                set_led_brightness(LED_CHANNEL_RED, 0.25, pca)
-
-            # Optional: Add a delay or keep the LED on for a certain duration
-            time.sleep(2)
+            beat()
+
+            # Only the newest reply matters; older ones are skipped entirely
+            message = get_newest_message(sentiment_queue, timeout=0.05)
+            if message is not None:
+                reply_id, sentences = message
+                sentiments = model.classify(sentences) if sentences else []
+                telemetry.inc("sentiment_replies_total")
+                print(f"Sentiment Analysis Result: {sentiments}")
+
+            while True:
+                try:
+                    playing = speech_events.get_nowait()
+                except queue.Empty:
+                    break
+
+            if playing is None or playing == shown or playing[0] != reply_id:
+                continue
+            index = playing[1]
+            if index >= len(sentiments):
+                continue
+
+            sentiment = sentiments[index]
+            print(f"Sentence {index} sentiment: {sentiment}")
+            green, red = SENTIMENT_COLORS.get(sentiment, SENTIMENT_COLORS['neutral'])
+            fade_leds({LED_CHANNEL_GREEN: green, LED_CHANNEL_RED: red}, current, pca)
+            shown = playing
 
     except KeyboardInterrupt:
         print("Sentiment LED handler interrupted by user.")
@@ -111,12 +277,47 @@ def sentiment_led_handler(sentiment_queue, running):
         pca.deinit()
         print("Sentiment LED handler terminated gracefully.")
 
-def start_sentiment_led_process(sentiment_queue, running):
+def start_sentiment_led_process(sentiment_queue, speech_events, running):
     """Start the sentiment LED handler process."""
     sentiment_process = multiprocessing.Process(
         target=sentiment_led_handler,
-        args=(sentiment_queue, running),
+        args=(sentiment_queue, speech_events, running),
         name="SentimentLEDHandler"
     )
     sentiment_process.start()
     return sentiment_process
+
+def benchmark(texts, backends=("torch", "quantized", "onnx"), num_threads=SENTIMENT_NUM_THREADS, repeats=5):
+    """
+    Time each backend on `texts` and report agreement with the fp32 PyTorch model.
+    """
+    reference = SentimentModel("torch", num_threads=num_threads).classify(texts)
+
+    for backend in backends:
+        model = SentimentModel(backend, num_threads=num_threads)
+
+        latencies = []
+        for _ in range(repeats):
+            for text in texts:
+                start = time.perf_counter()
+                model.classify([text])
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+
+        labels = model.classify(texts)
+        agreement = sum(a == b for a, b in zip(labels, reference)) / len(texts)
+        print(f"{backend:9s} mean {1000 * sum(latencies) / len(latencies):7.1f} ms  "
+              f"p95 {1000 * latencies[int(len(latencies) * 0.95) - 1]:7.1f} ms  "
+              f"agreement with fp32 {100 * agreement:5.1f}%")
+
+if __name__ == "__main__":
+    benchmark([
+        "What a splendid day it is to be alive and in good company.",
+        "I'm afraid the news is grim, and there is little to be done about it.",
+        "The universe is but one vast symbol of God.",
+        "No great man lives in vain; the history of the world is but the biography of great men.",
+        "Blessed is he who has found his work; let him ask no other blessedness.",
+        "Silence is deep as eternity, speech is shallow as time.",
+        "That is a dreadful idea and I want nothing to do with it.",
+        "Thank you, I appreciate your kind words very much.",
+    ])
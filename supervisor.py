@@ -0,0 +1,179 @@
+"""
+Starts the robot's worker processes, pins them to CPUs with nice levels, restarts any
+that crash or stop sending heartbeats, and shuts them all down cleanly.
+
+Workers that want hang detection call `beat()` from their main loop. Workers without a
+heartbeat timeout are only restarted when their process exits.
+"""
+import multiprocessing
+import os
+import time
+
+import psutil
+
+# Set in each worker process by `run_worker`
+_heartbeats = None
+_heartbeat_index = None
+
+def beat():
+    """Record that the current worker is still making progress. Safe to call anywhere."""
+    if _heartbeats is not None:
+        _heartbeats[_heartbeat_index] = time.time()
+
+def run_worker(index, heartbeats, name, target, args, cpus, nice):
+    """Process entry point: apply scheduling settings, then run the worker function."""
+    global _heartbeats, _heartbeat_index
+    _heartbeats = heartbeats
+    _heartbeat_index = index
+    beat()
+
+    if cpus:
+        available = os.sched_getaffinity(0)
+        pinned = set(cpus) & available
+        if pinned:
+            os.sched_setaffinity(0, pinned)
+    if nice:
+        try:
+            os.nice(nice)
+        except PermissionError:
+            print(f"[supervisor] {name}: not permitted to set nice {nice}")
+
+    target(*args)
+
+class Worker:
+    """
+    A supervised worker process.
+
+    Parameters:
+        name (str): Name shown in reports.
+        target (callable): Function run in the process.
+        args (tuple): Arguments for `target`.
+        cpus (iterable): CPUs the process may run on, or None for all.
+        nice (int): Nice increment; negative values need root.
+        heartbeat_timeout (float): Seconds without a `beat()` before the worker is
+            considered hung and restarted, or None to only watch for exits.
+    """
+    def __init__(self, name, target, args=(), cpus=None, nice=0, heartbeat_timeout=None):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.cpus = cpus
+        self.nice = nice
+        self.heartbeat_timeout = heartbeat_timeout
+        self.process = None
+        self.started_at = 0
+        self.restarts = 0
+        self.next_start = 0
+        self.backoff = 1.0
+
+class Supervisor:
+    def __init__(self, workers, running, startup_grace=60.0, report_interval=30.0, max_backoff=30.0):
+        self.workers = workers
+        self.running = running
+        self.startup_grace = startup_grace
+        self.report_interval = report_interval
+        self.max_backoff = max_backoff
+        self.heartbeats = multiprocessing.RawArray('d', len(workers))
+        self.cpu_usage = {}
+
+    def start(self, index):
+        worker = self.workers[index]
+        worker.process = multiprocessing.Process(
+            target=run_worker,
+            args=(index, self.heartbeats, worker.name, worker.target, worker.args, worker.cpus, worker.nice),
+            name=worker.name
+        )
+        worker.started_at = time.time()
+        self.heartbeats[index] = worker.started_at
+        worker.process.start()
+
+    def restart(self, index, reason):
+        worker = self.workers[index]
+        print(f"[supervisor] Restarting {worker.name} ({reason}) in {worker.backoff:.0f}s")
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+        worker.restarts += 1
+        worker.next_start = time.time() + worker.backoff
+        worker.backoff = min(worker.backoff * 2, self.max_backoff)
+        worker.process = None
+
+    def check(self):
+        now = time.time()
+        for index, worker in enumerate(self.workers):
+            if worker.process is None:
+                if now >= worker.next_start:
+                    self.start(index)
+                continue
+
+            if not worker.process.is_alive():
+                self.restart(index, f"exit code {worker.process.exitcode}")
+                continue
+
+            if now - worker.started_at > 4 * self.max_backoff:
+                # it's been up for a while, so forget earlier crashes
+                worker.backoff = 1.0
+
+            if worker.heartbeat_timeout is None or now - worker.started_at < self.startup_grace:
+                continue
+
+            silent = now - self.heartbeats[index]
+            if silent > worker.heartbeat_timeout:
+                self.restart(index, f"no heartbeat for {silent:.0f}s")
+
+    def report(self):
+        lines = ["[supervisor] worker            pid    cpu%  restarts"]
+        for worker in self.workers:
+            pid = worker.process.pid if worker.process is not None else None
+            cpu = None
+            if pid is not None:
+                try:
+                    process = self.cpu_usage.get(pid) or self.cpu_usage.setdefault(pid, psutil.Process(pid))
+                    cpu = process.cpu_percent(interval=None)
+                except psutil.NoSuchProcess:
+                    pass
+            cpu_text = f"{cpu:6.1f}" if cpu is not None else "     -"
+            lines.append(f"[supervisor] {worker.name:16s} {pid or '-':>6} {cpu_text} {worker.restarts:9d}")
+        print("\n".join(lines))
+
+    def run(self):
+        """Start every worker and supervise them until `running` is cleared or Ctrl+C."""
+        for index in range(len(self.workers)):
+            self.start(index)
+
+        last_report = time.time()
+        try:
+            while self.running.value:
+                time.sleep(1)
+                self.check()
+                if time.time() - last_report >= self.report_interval:
+                    self.report()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            print("\n[supervisor] Gracefully stopping...")
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout=5.0):
+        """Ask workers to stop via `running`, then terminate any that don't exit in time."""
+        self.running.value = False
+        deadline = time.time() + timeout
+
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout=max(0, deadline - time.time()))
+
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                print(f"[supervisor] Terminating {worker.name}")
+                worker.process.terminate()
+                worker.process.join(timeout=2)
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+
+        self.report()
+        print("[supervisor] Stopped all processes.")
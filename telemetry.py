@@ -0,0 +1,182 @@
+"""
+Low-overhead runtime metrics shared across the robot's processes, served in Prometheus
+text format.
+
+The registry is a fixed array of doubles in shared memory, created at import time so
+every forked worker writes to the same array (like the queues in main.py). Each metric
+has a single writer process, so updates don't take a lock. The HTTP server runs in a
+thread of the supervising process, where it can also sample queue depths and
+per-process CPU and memory.
+
+    curl http://127.0.0.1:9108/metrics
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import multiprocessing
+import os
+import threading
+import time
+
+import psutil
+
+METRICS_HOST = os.getenv("ROBOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("ROBOT_METRICS_PORT", "9108"))
+
+# name -> (type, help)
+METRICS = {
+    "vision_frames_total": ("counter", "Camera frames processed by the vision loop."),
+    "vision_detections_total": ("counter", "Frames in which a face was detected."),
+    "pid_updates_total": ("counter", "Pan/tilt control loop updates."),
+    "servo_writes_total": ("counter", "Servo angle writes."),
+    "control_latency_seconds": ("gauge", "Frame-to-actuation latency of the latest control update."),
+    "oled_frames_total": ("counter", "Frames pushed to the OLED display."),
+    "oled_bytes_total": ("counter", "Bytes sent to the OLED display."),
+    "audio_blocks_total": ("counter", "Audio blocks written to the output stream."),
+    "sentiment_replies_total": ("counter", "Replies scored by the sentiment model."),
+    "transcriptions_total": ("counter", "Transcriptions received from speech recognition."),
+    "vision_cpu_seconds_saved_total": ("counter", "Estimated vision CPU-seconds saved by the reduced camera mode."),
+    "listener_cpu_seconds_saved_total": ("counter", "Estimated speech recognition CPU-seconds saved while no face is present."),
+    "vision_reduced": ("gauge", "1 while the camera runs at reduced resolution and frame rate."),
+    "listener_gated": ("gauge", "1 while speech recognition is paused because no face is present."),
+}
+
+# counters that are also exposed as a per-second rate gauge
+RATES = {
+    "vision_frames_total": "vision_fps",
+    "pid_updates_total": "pid_loop_hz",
+    "servo_writes_total": "servo_writes_per_second",
+    "oled_frames_total": "oled_fps",
+    "oled_bytes_total": "oled_bytes_per_second",
+}
+
+_index = {name: i for i, name in enumerate(METRICS)}
+_values = multiprocessing.RawArray('d', len(METRICS))
+
+def inc(name, amount=1):
+    """Add to a counter. Only one process may write each metric."""
+    _values[_index[name]] += amount
+
+def set_value(name, value):
+    """Set a gauge. Only one process may write each metric."""
+    _values[_index[name]] = value
+
+def get(name):
+    return _values[_index[name]]
+
+class MetricsServer:
+    """
+    Serves /metrics from a background thread.
+
+    Parameters:
+        queues (dict): Queue label -> multiprocessing.Queue whose depth is reported.
+        workers (list): supervisor.Worker objects whose CPU, memory and restarts are reported.
+        sample_interval (float): Seconds between rate and CPU samples.
+    """
+    def __init__(self, queues, workers, host=METRICS_HOST, port=METRICS_PORT, sample_interval=1.0):
+        self.queues = queues
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.rates = {}
+        self.process_stats = {}
+        self.ps_processes = {}
+
+    def sample(self):
+        """Periodically compute counter rates and per-process CPU/RSS."""
+        previous = {name: get(name) for name in RATES}
+        previous_time = time.time()
+        while True:
+            time.sleep(self.sample_interval)
+            now = time.time()
+            elapsed = now - previous_time
+            rates = {}
+            for name, rate_name in RATES.items():
+                value = get(name)
+                rates[rate_name] = max(0.0, value - previous[name]) / elapsed
+                previous[name] = value
+            previous_time = now
+
+            stats = {}
+            for worker in self.workers:
+                if worker.process is None or worker.process.pid is None:
+                    continue
+                pid = worker.process.pid
+                try:
+                    process = self.ps_processes.get(pid) or self.ps_processes.setdefault(pid, psutil.Process(pid))
+                    stats[worker.name] = (process.cpu_percent(interval=None), process.memory_info().rss)
+                except psutil.NoSuchProcess:
+                    self.ps_processes.pop(pid, None)
+
+            with self.lock:
+                self.rates = rates
+                self.process_stats = stats
+
+    def render(self):
+        """Return the current metrics in Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP robot_{name} {help_text}")
+            lines.append(f"# TYPE robot_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"robot_{name}{labels} {value}")
+
+        for name, (kind, help_text) in METRICS.items():
+            metric(name, kind, help_text, [("", get(name))])
+
+        with self.lock:
+            rates = dict(self.rates)
+            process_stats = dict(self.process_stats)
+
+        for name, rate_name in RATES.items():
+            metric(rate_name, "gauge", f"Per-second rate of {name}.", [("", rates.get(rate_name, 0.0))])
+
+        depths = []
+        for label, queue in self.queues.items():
+            try:
+                depths.append((f'{{queue="{label}"}}', queue.qsize()))
+            except NotImplementedError:
+                pass
+        metric("queue_depth", "gauge", "Items waiting in each inter-process queue.", depths)
+
+        metric("process_cpu_percent", "gauge", "CPU usage of each worker process.",
+               [(f'{{worker="{name}"}}', cpu) for name, (cpu, rss) in process_stats.items()])
+        metric("process_rss_bytes", "gauge", "Resident memory of each worker process.",
+               [(f'{{worker="{name}"}}', rss) for name, (cpu, rss) in process_stats.items()])
+        metric("worker_restarts_total", "counter", "Times the supervisor restarted each worker.",
+               [(f'{{worker="{worker.name}"}}', worker.restarts) for worker in self.workers])
+
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """Start serving in background threads. Returns the HTTP server, or None if it couldn't bind."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes are frequent; don't clutter the console
+                pass
+
+        try:
+            httpd = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            # e.g. the port is taken; the robot runs fine without its metrics
+            print(f"Not serving metrics on {self.host}:{self.port}: {e}")
+            return None
+        httpd.daemon_threads = True
+        threading.Thread(target=self.sample, daemon=True, name="metrics-sampler").start()
+        threading.Thread(target=httpd.serve_forever, daemon=True, name="metrics-server").start()
+        print(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return httpd
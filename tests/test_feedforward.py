@@ -0,0 +1,69 @@
+import math
+
+from image_search.feedforward import AxisCalibration, FeedForwardPID, measure_degrees_per_unit
+from image_search.pid import PID
+
+def make_controller(degrees_per_unit=1.0, jump_threshold=5.0):
+    # 640 px across 64 degrees: 10 px per degree
+    calibration = AxisCalibration(640, 64.0, degrees_per_unit)
+    controller = FeedForwardPID(PID(0.01, 0.001, 0.001), calibration, jump_threshold, servo_speed=100.0, settle_margin=0.05)
+    controller.initialize(now=0.0)
+    return controller
+
+def test_large_error_jumps_by_the_geometric_angle():
+    controller = make_controller()
+    assert controller.update(200, now=1.0, captured_at=0.95) == 20.0
+    assert controller.jumps == 1
+
+def test_jump_accounts_for_servo_degrees_per_unit():
+    # a servo that turns 0.8 degrees per unit needs a bigger command to turn 20 degrees
+    controller = make_controller(degrees_per_unit=0.8)
+    assert controller.update(200, now=1.0) == 25.0
+
+def test_small_error_uses_the_pid():
+    controller = make_controller()
+    pid = PID(0.01, 0.001, 0.001)
+    pid.initialize(now=0.0)
+    assert controller.update(30, now=1.0) == pid.update(30, now=1.0)
+    assert controller.jumps == 0
+
+def test_frames_captured_before_the_jump_lands_are_ignored():
+    controller = make_controller()
+    controller.update(200, now=1.0)
+
+    # 20 degrees at 100 deg/s takes 0.2 s, plus the 0.05 s margin
+    assert math.isclose(controller.blind_until, 1.25)
+    assert controller.update(200, now=1.1, captured_at=1.05) == 0.0
+    assert controller.update(200, now=1.3, captured_at=1.24) == 0.0
+    assert controller.jumps == 1
+
+    # a frame captured after the servo landed is acted on again
+    assert controller.update(3, now=1.4, captured_at=1.3) != 0.0
+
+def test_pid_restarts_from_the_jump():
+    controller = make_controller()
+    for i in range(1, 5):
+        controller.update(40, now=i * 0.1)
+    assert controller.pid.cI > 0
+
+    controller.update(200, now=1.0)
+    assert controller.pid.cI == 0
+    assert controller.pid.prevError == 0
+    assert controller.pid.prevTime == 1.0
+
+    # the first fine update after the jump matches a freshly initialized PID
+    pid = PID(0.01, 0.001, 0.001)
+    pid.initialize(now=1.0)
+    assert controller.update(10, now=1.5, captured_at=1.4) == pid.update(10, now=1.5)
+
+def test_infinite_threshold_is_pure_pid():
+    controller = make_controller(jump_threshold=math.inf)
+    pid = PID(0.01, 0.001, 0.001)
+    pid.initialize(now=0.0)
+    for i, error in enumerate([300, -300, 150, 0], start=1):
+        assert controller.update(error, now=i * 0.1) == pid.update(error, now=i * 0.1)
+    assert controller.jumps == 0
+
+def test_measure_degrees_per_unit():
+    # the target shifted 160 px (16 degrees) for a 20 unit move
+    assert measure_degrees_per_unit(-160, 20, 640, 64.0) == 0.8
@@ -0,0 +1,65 @@
+from image_search.pid import PID
+
+class LegacyPID:
+    """The PID update as it was before integral_limit and derivative_alpha existed."""
+    def __init__(self, kP, kI, kD, now):
+        self.kP, self.kI, self.kD = kP, kI, kD
+        self.prevTime = now
+        self.prevError = 0
+        self.cI = 0
+
+    def update(self, error, now):
+        deltaTime = now - self.prevTime
+        deltaError = error - self.prevError
+        self.cI += error * deltaTime
+        cD = (deltaError / deltaTime) if deltaTime > 0 else 0
+        self.prevTime = now
+        self.prevError = error
+        return sum([self.kP * error, self.kI * self.cI, self.kD * cD])
+
+ERRORS = [120, 95, -40, 3, 0, 0, 250, -250, 17, 17, 17]
+TIMES = [0.07 * (i + 1) for i in range(len(ERRORS))]
+
+def test_default_options_match_legacy_output_exactly():
+    pid = PID(0.0125, 0.0005, 0.001)
+    pid.initialize(now=0.0)
+    legacy = LegacyPID(0.0125, 0.0005, 0.001, now=0.0)
+
+    for error, now in zip(ERRORS, TIMES):
+        assert pid.update(error, now=now) == legacy.update(error, now)
+
+def test_repeated_timestamp_has_no_derivative():
+    pid = PID(0, 0, 1.0)
+    pid.initialize(now=1.0)
+    assert pid.update(50, now=1.0) == 0
+
+def test_integral_clamp_holds_in_both_directions():
+    pid = PID(0, 1.0, 0, integral_limit=2.0)
+    pid.initialize(now=0.0)
+
+    for i in range(1, 50):
+        pid.update(100, now=i * 0.1)
+        assert pid.cI <= 2.0
+    assert pid.cI == 2.0
+
+    for i in range(50, 100):
+        pid.update(-100, now=i * 0.1)
+        assert pid.cI >= -2.0
+    assert pid.cI == -2.0
+
+def test_integral_unclamped_by_default():
+    pid = PID(0, 1.0, 0)
+    pid.initialize(now=0.0)
+    for i in range(1, 11):
+        pid.update(100, now=float(i))
+    assert pid.cI == 1000
+
+def test_derivative_alpha_smooths_a_step():
+    smooth = PID(0, 0, 1.0, derivative_alpha=0.25)
+    smooth.initialize(now=0.0)
+
+    # a step of 10 over 1 s gives a raw derivative of 10; the filter passes a quarter of it
+    assert smooth.update(10, now=1.0) == 2.5
+
+    # with the error held, the raw derivative is 0 and the filtered one decays
+    assert smooth.update(10, now=2.0) == 0.75 * 2.5
@@ -0,0 +1,426 @@
+"""
+Asynchronous conversation turn engine.
+
+Each transcribed utterance starts a turn that runs as three asyncio stages joined by
+bounded queues:
+
+    LLM (streamed sentences) -> TTS (audio clips) -> playback (hand-off to audio_player)
+
+A full queue makes the stage before it wait, so the LLM stream isn't read faster than
+speech can be synthesized, and clips aren't synthesized faster than they can be played.
+Every turn has a cancellation token. A new utterance or shutdown cancels the running
+turn, which aborts in-flight HTTP requests, deletes clips that haven't been played, and
+tells `audio_player` to drop or cut short any audio already handed to it. There's no echo
+cancellation, so the listener keeps the microphone off while the robot speaks: a new
+utterance cancels a turn that is still thinking or synthesizing, but can't barge in on
+speech that is already playing.
+
+With Eleven Labs, speech is requested as raw PCM and forwarded to `audio_player` chunk by
+chunk, so playback starts on the first chunk with no MP3 file or ffmpeg decode. Compare
+the two paths with:
+
+    python turn_engine.py "Some sentence to speak."
+"""
+from collections import namedtuple
+import asyncio
+import os
+import re
+import threading
+import time
+import wave
+
+import anthropic
+import httpx
+from piper.voice import PiperVoice
+
+from inference_server import INFERENCE_SERVER, InferenceClient, InferenceUnavailable
+
+SYSTEM_PROMPT = (
+    "The assistant is integrated into a robot that communicates through a Raspberry Pi device. "
+    "Text from the robot's microphone is passed to the assistant via the Anthropic API. "
+    "The assistant may also be passed some parsed visual cues as text. The robot has an integrated camera and face tracking device. "
+    "The assistant is named Thomas MacLarlyle. It thinks and speaks in the style of Thomas Carlyle. "
+    "Keeps things short and conversational. Brevity is favored, to allow an interactive exchange. The assistant replies in one or two sentences unless a longer monologue is warranted. "
+    "Note that because voice transcription is being done with a simple Whisper model before the text is passed to the assistant, there may be some errors in the text transcription. Buest guesses should be used as to the intention of the speaker."
+)
+
+# Piper TTS Setup
+USE_LOCAL_TTS = False
+PIPER_MODEL = os.path.expanduser('~/Documents/piper/') + "en_GB-northern_english_male-medium.onnx"
+
+# Eleven Labs TTS Setup
+ELEVEN_LABS_VOICE_ID = 'ZQe5CZNOzWyzPSCn5a3c'  # "George"
+ELEVEN_LABS_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_LABS_VOICE_ID}"
+
+# Stream raw 16-bit mono PCM from Eleven Labs straight to the player, instead of
+# downloading an MP3 that has to be decoded with ffmpeg before playback can start
+STREAM_TTS_PCM = True
+ELEVEN_LABS_PCM_RATE = 22050
+PCM_CHUNK_BYTES = 2048  # Whole 16-bit frames, so every chunk can be played as-is
+
+# Bounded queue sizes between stages
+SENTENCE_QUEUE_SIZE = 2  # Sentences waiting for TTS
+CLIP_QUEUE_SIZE = 2  # Synthesized clips waiting to be handed to the player
+MAX_QUEUED_CLIPS = 2  # Clips allowed in audio_player's queue before playback backs up
+
+# A sentence ends at ., ! or ? followed by whitespace
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+# A clip whose audio arrives on the PCM queue as (stream_id, chunk), ending with a None chunk
+PCMStream = namedtuple("PCMStream", ["stream_id", "rate", "sample_width", "channels"])
+
+def eleven_labs_request(sentence):
+    """Headers and JSON payload for an Eleven Labs TTS request."""
+    headers = {
+        "xi-api-key": os.getenv("ELEVEN_LABS_API_KEY"),
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "text": sentence,
+        "voice_settings": {
+            "stability": 0.5,
+            "similarity_boost": 0.7
+        },
+        "model_id": "eleven_turbo_v2"
+    }
+    return headers, payload
+
+def remove_clip(path):
+    """Delete an audio clip if it was written."""
+    if os.path.exists(path):
+        os.remove(path)
+
+class CancelToken:
+    """Cancellation token for one turn: cancelling it cancels every stage of the turn."""
+    def __init__(self, turn_id):
+        self.turn_id = turn_id
+        self.task = None
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+class TurnEngine:
+    """
+    Runs conversation turns on an asyncio loop in a background thread.
+
+    Parameters:
+        state: Shared animation state (listening, thinking, speaking, idle).
+        running (multiprocessing.Value): Cleared on shutdown.
+        sentiment_queue (multiprocessing.Queue): Receives (turn_id, sentences) per reply.
+        audio_queue (multiprocessing.Queue): Receives (path or PCMStream, turn_id, sentence_index) clips.
+        pcm_queue (multiprocessing.Queue): Receives (stream_id, chunk) audio for PCMStream clips.
+        turn_counter (multiprocessing.Value): Shared, monotonically increasing turn id.
+        cancel_before (multiprocessing.Value): Clips from turns with a lower id are stale.
+    """
+    def __init__(self, state, running, sentiment_queue, audio_queue, pcm_queue, turn_counter, cancel_before):
+        self.state = state
+        self.running = running
+        self.sentiment_queue = sentiment_queue
+        self.audio_queue = audio_queue
+        self.pcm_queue = pcm_queue
+        self.turn_counter = turn_counter
+        self.cancel_before = cancel_before
+        self.prompt_history = []
+        self.loop = None
+        self.utterances = None
+        self.current = None
+        self.thread = None
+        self.ready = threading.Event()
+
+        self.voice = None
+        if USE_LOCAL_TTS and not INFERENCE_SERVER:
+            self.voice = PiperVoice.load(PIPER_MODEL)
+        self.inference_client = InferenceClient() if INFERENCE_SERVER else None
+
+    def start(self):
+        """Start the engine's event loop in a daemon thread."""
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True, name="turn-engine")
+        self.thread.start()
+        self.ready.wait()
+
+    def join(self, timeout=None):
+        """Wait for the engine to cancel its last turn and exit after `running` is cleared."""
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def submit(self, text):
+        """Start a new turn for `text`, cancelling the current one. Safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.utterances.put_nowait, text)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.utterances = asyncio.Queue()
+        self.llm = anthropic.AsyncAnthropic()
+        self.http = httpx.AsyncClient(timeout=30.0)
+        self.ready.set()
+
+        try:
+            while self.running.value:
+                try:
+                    text = await asyncio.wait_for(self.utterances.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+
+                # only the newest utterance matters
+                while not self.utterances.empty():
+                    text = self.utterances.get_nowait()
+
+                await self.cancel_current("new utterance")
+                self.current = self.new_token()
+                self.current.task = asyncio.create_task(self.run_turn(self.current, text))
+        finally:
+            await self.cancel_current("shutdown")
+            await self.http.aclose()
+
+    def new_token(self):
+        with self.turn_counter.get_lock():
+            self.turn_counter.value += 1
+            return CancelToken(self.turn_counter.value)
+
+    async def cancel_current(self, reason):
+        token = self.current
+        if token is None:
+            return
+
+        # anything this turn already handed to audio_player is now stale, even if the
+        # turn itself has finished
+        self.cancel_before.value = token.turn_id + 1
+        if token.task.done():
+            return
+        print(f"Cancelling turn {token.turn_id}: {reason}")
+        token.cancel()
+        try:
+            await token.task
+        except asyncio.CancelledError:
+            pass
+
+    async def run_turn(self, token, text):
+        self.state.value = "thinking"
+        sentences = asyncio.Queue(maxsize=SENTENCE_QUEUE_SIZE)
+        clips = asyncio.Queue(maxsize=CLIP_QUEUE_SIZE)
+
+        try:
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(self.llm_stage(token, text, sentences))
+                stages.create_task(self.tts_stage(token, sentences, clips))
+                stages.create_task(self.playback_stage(token, clips))
+        except* Exception as errors:
+            for error in errors.exceptions:
+                print(f"Turn {token.turn_id} failed: {error}")
+        finally:
+            # After thinking, set state back to idle
+            if self.state.value != "speaking":  # Prevent overriding 'speaking' state
+                self.state.value = "idle"
+
+    async def llm_stage(self, token, prompt, sentences):
+        """Stream the reply from the LLM, passing on each sentence as soon as it's complete."""
+        new_prompt_series = self.prompt_history + [{"role": "user", "content": prompt}]
+        reply = []
+        buffer = ""
+
+        async def emit(sentence):
+            reply.append(sentence)
+            await sentences.put((len(reply) - 1, sentence))
+
+        async with self.llm.messages.stream(
+            model="claude-3-5-sonnet-20240620",
+            max_tokens=1000,
+            temperature=0,
+            system=SYSTEM_PROMPT,
+            messages=new_prompt_series
+        ) as stream:
+            async for chunk in stream.text_stream:
+                buffer += chunk
+                *complete, buffer = SENTENCE_END.split(buffer)
+                for sentence in complete:
+                    if sentence.strip():
+                        await emit(sentence.strip())
+
+        if buffer.strip():
+            await emit(buffer.strip())
+
+        # end of reply; the TTS stage finishes whatever it already has
+        await sentences.put(None)
+
+        response_text = " ".join(reply)
+        print(f"\nLLM Response: {response_text}")
+
+        # a cancelled turn never gets here, so only completed exchanges enter the history
+        self.prompt_history = new_prompt_series + [{"role": "assistant", "content": response_text}]
+
+        # Send the response sentences for sentiment analyis
+        self.sentiment_queue.put((token.turn_id, reply))
+
+    async def tts_stage(self, token, sentences, clips):
+        """Synthesize each sentence into an audio clip."""
+        while (item := await sentences.get()) is not None:
+            index, sentence = item
+            if STREAM_TTS_PCM and not USE_LOCAL_TTS:
+                await self.stream_speech(token.turn_id, index, sentence, clips)
+                continue
+
+            path = await self.synthesize(token.turn_id, index, sentence)
+            if path is None:
+                continue
+            try:
+                await clips.put((index, path))
+            except asyncio.CancelledError:
+                os.remove(path)
+                raise
+
+        await clips.put(None)
+
+    async def playback_stage(self, token, clips):
+        """Hand clips to audio_player, waiting while its queue is full."""
+        try:
+            while (item := await clips.get()) is not None:
+                index, path = item
+                while self.audio_queue.qsize() >= MAX_QUEUED_CLIPS:
+                    await asyncio.sleep(0.05)
+                self.audio_queue.put((path, token.turn_id, index))
+        finally:
+            # delete clips that were synthesized but will never be played
+            while not clips.empty():
+                item = clips.get_nowait()
+                if item is not None and isinstance(item[1], str):
+                    remove_clip(item[1])
+
+    async def stream_speech(self, turn_id, index, sentence, clips):
+        """
+        Stream a sentence's speech from Eleven Labs as raw PCM. The clip is handed on as
+        soon as the response starts, and chunks go to the player as they arrive.
+        """
+        headers, payload = eleven_labs_request(sentence)
+        clip = PCMStream(f"{turn_id}-{index}", ELEVEN_LABS_PCM_RATE, 2, 1)
+
+        async with self.http.stream(
+            "POST",
+            ELEVEN_LABS_URL,
+            params={"output_format": f"pcm_{ELEVEN_LABS_PCM_RATE}"},
+            headers=headers,
+            json=payload
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                print(f"Error: {response.status_code} - {response.text}")
+                return
+
+            await clips.put((index, clip))
+            try:
+                async for chunk in response.aiter_bytes(PCM_CHUNK_BYTES):
+                    self.pcm_queue.put((clip.stream_id, chunk))
+            finally:
+                # always end the stream, so the player never waits on a cancelled one
+                self.pcm_queue.put((clip.stream_id, None))
+
+    async def synthesize(self, turn_id, index, sentence):
+        """Convert a sentence to an audio file, returning its path (or None on failure)."""
+        if USE_LOCAL_TTS:
+            wav_file_path = f'output_{turn_id}_{index}.wav'
+            synthesis = asyncio.ensure_future(asyncio.to_thread(self.synthesize_to_wav, sentence, wav_file_path))
+            try:
+                await asyncio.shield(synthesis)
+            except asyncio.CancelledError:
+                # the thread can't be interrupted, so delete its file once it's written
+                synthesis.add_done_callback(lambda _: remove_clip(wav_file_path))
+                raise
+            except Exception:
+                remove_clip(wav_file_path)
+                raise
+            return wav_file_path
+
+        # Use the Eleven Labs API
+        file_path = f'output_{turn_id}_{index}.mp3'
+        headers, payload = eleven_labs_request(sentence)
+        headers["Accept"] = "audio/mpeg"
+
+        response = await self.http.post(ELEVEN_LABS_URL, headers=headers, json=payload)
+
+        if response.status_code != 200:
+            print(f"Error: {response.status_code} - {response.text}")
+            return None
+
+        # Save the response content (audio data) to an MP3 file
+        with open(file_path, 'wb') as mp3_file:
+            mp3_file.write(response.content)
+        return file_path
+
+    def synthesize_to_wav(self, sentence, wav_file_path):
+        """Synthesize a sentence with Piper, on the inference server if possible."""
+        if self.inference_client is not None:
+            try:
+                wav_data = self.inference_client.synthesize(sentence)
+                with open(wav_file_path, 'wb') as wav_file:
+                    wav_file.write(wav_data)
+                return
+            except InferenceUnavailable:
+                pass
+
+        if self.voice is None:
+            print("Loading local Piper voice.")
+            self.voice = PiperVoice.load(PIPER_MODEL)
+        with wave.open(wav_file_path, 'w') as wav_file:
+            self.voice.synthesize(sentence, wav_file, sentence_silence=0.75)
+
+def benchmark(text, repeats=3):
+    """
+    Compare time to first playable audio for the MP3 download + pydub/ffmpeg decode path
+    against streaming raw PCM, using the Eleven Labs API.
+    """
+    import resource
+    from pydub import AudioSegment
+
+    def child_cpu():
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def own_cpu():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+
+    results = {"mp3 + ffmpeg": [], "pcm stream": []}
+    with httpx.Client(timeout=30.0) as http:
+        for _ in range(repeats):
+            # Current path: download the whole MP3, write it, decode it with ffmpeg
+            headers, payload = eleven_labs_request(text)
+            headers["Accept"] = "audio/mpeg"
+            cpu_before = own_cpu() + child_cpu()
+            start = time.perf_counter()
+            response = http.post(ELEVEN_LABS_URL, headers=headers, json=payload)
+            response.raise_for_status()
+            with open("benchmark.mp3", "wb") as mp3_file:
+                mp3_file.write(response.content)
+            audio = AudioSegment.from_file("benchmark.mp3", format="mp3")
+            first_audio = time.perf_counter() - start
+            os.remove("benchmark.mp3")
+            results["mp3 + ffmpeg"].append((first_audio, len(audio) / 1000, own_cpu() + child_cpu() - cpu_before))
+
+            # Streaming path: raw PCM chunks are playable as soon as they arrive
+            headers, payload = eleven_labs_request(text)
+            cpu_before = own_cpu() + child_cpu()
+            start = time.perf_counter()
+            first_audio = None
+            total_bytes = 0
+            with http.stream("POST", ELEVEN_LABS_URL, params={"output_format": f"pcm_{ELEVEN_LABS_PCM_RATE}"},
+                             headers=headers, json=payload) as response:
+                response.raise_for_status()
+                for chunk in response.iter_bytes(PCM_CHUNK_BYTES):
+                    if first_audio is None:
+                        first_audio = time.perf_counter() - start
+                    total_bytes += len(chunk)
+            results["pcm stream"].append((first_audio, total_bytes / (2 * ELEVEN_LABS_PCM_RATE), own_cpu() + child_cpu() - cpu_before))
+
+    for name, runs in results.items():
+        first = sum(r[0] for r in runs) / len(runs)
+        duration = sum(r[1] for r in runs) / len(runs)
+        cpu = sum(r[2] for r in runs) / len(runs)
+        print(f"{name:13s} first audio after {1000 * first:7.1f} ms  "
+              f"({duration:.2f} s of speech, {1000 * cpu:6.1f} ms CPU incl. child processes)")
+
+if __name__ == "__main__":
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    benchmark(" ".join(sys.argv[1:]) or "I have come to say a few words about the nature of heroes.")